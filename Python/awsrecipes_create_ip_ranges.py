@@ -1,22 +1,420 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import csv
+import datetime
+import heapq
+import json
 import os
 import sys
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Semaphore, Thread
+# Python2 vs Python3
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from netaddr import IPAddress, IPNetwork, iprange_to_cidrs
 
 from opinel.utils.aws import build_region_list, connect_service, get_name, handle_truncated_response
 from opinel.utils.cli_parser import OpinelArgumentParser
-from opinel.utils.console import configPrintException, printException, printInfo, prompt_4_value, prompt_4_yes_no
+from opinel.utils.console import configPrintException, printError, printException, printInfo, prompt_4_overwrite, prompt_4_value, prompt_4_yes_no
 from opinel.utils.credentials import read_creds
 from opinel.utils.fs import read_ip_ranges, save_ip_ranges
 from opinel.utils.globals import check_requirements
 from opinel.utils.profiles import AWSProfile, AWSProfiles
 
 
+########################################
+##### Globals
+########################################
+
+# API calls made in each region, with the service and the entities they return
+inventory_apis = [
+    ('ec2', 'describe_instances', 'Reservations'),
+    ('ec2', 'describe_addresses', 'Addresses'),
+    ('ec2', 'describe_vpcs', 'Vpcs'),
+    ('ec2', 'describe_subnets', 'Subnets'),
+]
+
+# Maximum number of requests per second for each service, in each account and region
+api_rates = {'ec2': 10}
+
+# Address size, in bits, of each IP version
+address_bits = {4: 32, 6: 128}
+
+
 ########################################
 ##### Helpers
 ########################################
 
+#
+# Token bucket shared by the threads that call the same API endpoint
+#
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+#
+# Get the API client and rate limiter of a profile, region and service; shared by all threads
+#
+def get_client(params, profile_name, region, service):
+    key = (profile_name, region, service)
+    with params['lock']:
+        if key not in params['clients']:
+            params['clients'][key] = connect_service(service, params['credentials'][profile_name], region)
+            params['rate_limiters'][key] = RateLimiter(api_rates[service])
+        return params['clients'][key], params['rate_limiters'][key]
+
+#
+# Worker: make one (profile, region, API) call, following pagination
+#
+def fetch_inventory(q, params):
+    while True:
+        profile_name, region, service, api, entity = q.get()
+        unit = (profile_name, region)
+        try:
+            try:
+                client, rate_limiter = get_client(params, profile_name, region, service)
+                if client:
+                    method = getattr(client, api)
+                    def rate_limited_call(**kwargs):
+                        rate_limiter.acquire()
+                        return method(**kwargs)
+                    entities = handle_truncated_response(rate_limited_call, {}, [entity])[entity]
+                    with params['lock']:
+                        params['inventory'][unit][api] = entities
+                else:
+                    with params['lock']:
+                        params['skipped'].add(unit)
+            except Exception as e:
+                with params['lock']:
+                    params['errors'].setdefault(unit, e)
+            finally:
+                # The unit is complete once all its API calls returned, whether they succeeded or not
+                with params['ready']:
+                    params['pending'][unit] -= 1
+                    if params['pending'][unit] == 0:
+                        params['ready'].notify_all()
+        finally:
+            q.task_done()
+
+#
+# Fetch the inventory of all profiles and regions concurrently, and yield it one (profile, region) at a time, in
+# order, as (profile name, region, entities per API or None if the connection failed, error). At most
+# max_pending_units regions are fetched ahead of the consumer, which bounds memory usage
+#
+def get_inventory(profile_names, credentials, regions, public_only, num_threads, max_pending_units):
+    apis = [(service, api, entity) for service, api, entity in inventory_apis if not public_only or api in ['describe_instances', 'describe_addresses']]
+    # Each unit must be registered once, its pending counter would be reset otherwise
+    units = list(OrderedDict.fromkeys((profile_name, region) for profile_name in profile_names if profile_name in credentials for region in regions))
+    lock = Lock()
+    params = {'credentials': credentials, 'clients': {}, 'rate_limiters': {}, 'inventory': {}, 'pending': {}, 'skipped': set(), 'errors': {},
+              'lock': lock, 'ready': Condition(lock)}
+    q = Queue()
+    for i in range(min(num_threads, len(units) * len(apis))):
+        worker = Thread(target = fetch_inventory, args = (q, params))
+        worker.daemon = True
+        worker.start()
+    window = Semaphore(max(1, max_pending_units))
+    def feed():
+        for unit in units:
+            window.acquire()
+            with lock:
+                params['inventory'][unit] = {}
+                params['pending'][unit] = len(apis)
+            for service, api, entity in apis:
+                q.put(unit + (service, api, entity))
+    feeder = Thread(target = feed)
+    feeder.daemon = True
+    feeder.start()
+    for unit in units:
+        with params['ready']:
+            while params['pending'].get(unit) != 0:
+                params['ready'].wait()
+            params['pending'].pop(unit)
+            region_inventory = params['inventory'].pop(unit)
+            if unit in params['skipped']:
+                region_inventory = None
+            error = params['errors'].pop(unit, None)
+        window.release()
+        yield unit[0], unit[1], region_inventory, error
+
+#
+# Get the prefixes of one account and region; each prefix is reported once
+#
+def get_region_prefixes(region_inventory, region, account_id, public_only):
+    prefixes = OrderedDict()
+
+    # Get public IP addresses associated with EC2 instances
+    ip_addresses = OrderedDict()
+    for reservation in region_inventory['describe_instances']:
+        for i in reservation['Instances']:
+            if 'PublicIpAddress' in i:
+                ip_addresses[i['PublicIpAddress']] = new_ip_info(region, i['InstanceId'], False)
+                get_name(i, ip_addresses[i['PublicIpAddress']], 'InstanceId')
+            if 'NetworkInterfaces' in i:
+                for eni in i['NetworkInterfaces']:
+                    if 'Association' in eni:
+                        ip_addresses[eni['Association']['PublicIp']] = new_ip_info(region, i['InstanceId'], False) # At that point, we don't know whether it's an EIP or not...
+                        get_name(i, ip_addresses[eni['Association']['PublicIp']], 'InstanceId')
+
+    # Get all EIPs (to handle unassigned cases)
+    for eip in region_inventory['describe_addresses']:
+        instance_id = eip['InstanceId'] if 'InstanceId' in eip else None
+        # EC2-Classic non associated EIPs have an empty string for instance ID (instead of lacking the attribute in VPC)
+        if instance_id == '':
+            instance_id = None
+        ip_addresses[eip['PublicIp']] = new_ip_info(region, instance_id, True)
+        ip_addresses[eip['PublicIp']]['name'] = instance_id
+
+    # Format
+    for ip in ip_addresses:
+        prefix = new_prefix(ip, ip_addresses[ip])
+        prefix['account_id'] = account_id
+        prefixes[ip] = prefix
+
+    if not public_only:
+
+        # Get all VPCs
+        for vpc in region_inventory['describe_vpcs']:
+            prefix = new_prefix(vpc['CidrBlock'], {})
+            prefix['id'] = vpc['VpcId']
+            prefix['name'] = get_name(vpc, {}, 'VpcId')
+            prefix['region'] = region
+            prefix['account_id'] = account_id
+            prefixes[vpc['CidrBlock']] = prefix
+
+        # Get all Subnets
+        for subnet in region_inventory['describe_subnets']:
+            prefix = new_prefix(subnet['CidrBlock'], {})
+            prefix['id'] = subnet['SubnetId']
+            prefix['name'] = get_name(subnet, {}, 'SubnetId')
+            prefix['region'] = region
+            prefix['account_id'] = account_id
+            prefixes[subnet['CidrBlock']] = prefix
+
+    return list(prefixes.values())
+
+#
+# Write prefixes to an ip-ranges file as they are collected: a JSON document in the format of save_ip_ranges, JSON
+# lines or CSV. The file is written under a temporary name and only replaces an existing file once complete. When
+# aggregate_attributes is set, prefixes are kept until the file is closed, and then aggregated
+#
+class IPRangesWriter(object):
+
+    def __init__(self, name, output_format, force_write, aggregate_attributes = None):
+        self.name = name
+        self.output_format = output_format
+        self.filename = 'ip-ranges-%s.%s' % (name, output_format)
+        self.count = 0
+        self.f = None
+        self.aggregate_attributes = aggregate_attributes
+        self.prefixes = [] if aggregate_attributes is not None else None
+        if not prompt_4_overwrite(self.filename, force_write):
+            return
+        fd, self.tmp_path = tempfile.mkstemp(dir = '.', prefix = '.ip-ranges-', suffix = '.tmp')
+        self.f = os.fdopen(fd, 'wt')
+        if output_format == 'json':
+            self.f.write('{"createDate": %s,"prefixes": [' % json.dumps(datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')))
+        elif output_format == 'csv':
+            self.f.write('account_id, region, ip, instance_id, instance_name\n')
+
+    def write(self, prefixes):
+        if not self.f:
+            return
+        if self.prefixes is not None:
+            self.prefixes += prefixes
+            return
+        self.write_prefixes(prefixes)
+
+    def write_prefixes(self, prefixes):
+        for prefix in prefixes:
+            if self.output_format == 'json':
+                self.f.write('%s%s' % (',' if self.count else '', json.dumps(prefix, separators = (',', ': '), sort_keys = True)))
+            elif self.output_format == 'jsonl':
+                self.f.write('%s\n' % json.dumps(prefix, sort_keys = True))
+            else:
+                self.f.write('%s, %s, %s, %s, %s\n' % (prefix.get('account_id'), prefix.get('region'), prefix['ip_prefix'], prefix.get('instance_id'), prefix.get('name')))
+            self.count += 1
+
+    def close(self, discard = False):
+        if not self.f:
+            return
+        if self.prefixes is not None and not discard:
+            ranges = get_prefix_ranges(self.prefixes)
+            for prefix_a, locations_a, prefix_b, locations_b in get_overlaps(ranges):
+                if prefix_b is None:
+                    printInfo('Prefix used in several accounts: %s (%s)' % (prefix_a, ', '.join(locations_a)))
+                else:
+                    printInfo('Overlapping prefixes: %s (%s) and %s (%s)' % (prefix_a, ', '.join(locations_a), prefix_b, ', '.join(locations_b)))
+            self.write_prefixes(aggregate_prefixes(ranges, self.aggregate_attributes))
+            self.prefixes = None
+        if self.output_format == 'json':
+            self.f.write(']}\n')
+        self.f.close()
+        self.f = None
+        if discard:
+            os.remove(self.tmp_path)
+        else:
+            os.rename(self.tmp_path, self.filename)
+
+#
+# Read the prefixes of a CSV file one row at a time. Columns are mapped to attributes following the header line, a
+# subset of the header line (attributes only) or column indices (attributes and mappings)
+#
+def read_csv_prefixes(filename, attributes, mappings, skip_first_line):
+    with open(filename, 'rt') as f:
+        reader = csv.reader(f)
+        columns = {}
+        if attributes == []:
+            # Follow structure of first line
+            headers = next(reader, [])
+            for index, attribute in enumerate(headers):
+                columns[attribute] = index
+        elif mappings == []:
+            # Follow structure of first line but only map a subset of fields
+            headers = next(reader, [])
+            for attribute in set(attributes + ['ip_prefix']):
+                columns[attribute] = headers.index(attribute)
+        else:
+            # Indices of columns are provided as an argument
+            for index, attribute in enumerate(attributes):
+                columns[attribute] = int(mappings[index])
+            if skip_first_line:
+                next(reader, None)
+        for values in reader:
+            if len(values) < len(columns):
+                continue
+            ip_prefix = dict((attribute, values[index]) for attribute, index in columns.items())
+            if 'ip_prefix' in columns and 'mask' in columns:
+                ip = ip_prefix.pop('ip_prefix')
+                mask = ip_prefix.pop('mask')
+                ip_prefix['ip_prefix'] = '%s/%s' % (ip, mask.replace('/',''))
+            yield ip_prefix
+
+#
+# Drop the prefixes that are not valid CIDRs, and optionally rewrite the others in canonical form (e.g. 10.1.2.3/16
+# becomes 10.1.0.0/16)
+#
+def check_prefixes(prefixes, normalize):
+    for prefix in prefixes:
+        try:
+            network = IPNetwork(prefix.get('ip_prefix', '').strip())
+        except Exception:
+            printError('Ignoring invalid CIDR: %s' % prefix.get('ip_prefix'))
+            continue
+        if normalize:
+            prefix['ip_prefix'] = str(network.cidr)
+        yield prefix
+
+#
+# Drop the prefixes that were already seen; only their CIDRs are kept in memory
+#
+def unique_prefixes(prefixes):
+    seen = set()
+    for prefix in prefixes:
+        if prefix.get('ip_prefix') in seen:
+            continue
+        seen.add(prefix.get('ip_prefix'))
+        yield prefix
+
+#
+# Get the address range of each prefix, as (IP version, first address, last address, prefix), skipping invalid CIDRs
+#
+def get_prefix_ranges(prefixes):
+    ranges = []
+    for prefix in prefixes:
+        try:
+            network = IPNetwork(prefix['ip_prefix'])
+        except Exception:
+            printError('Ignoring invalid CIDR: %s' % prefix.get('ip_prefix'))
+            continue
+        ranges.append((network.version, network.first, network.last, prefix))
+    return ranges
+
+#
+# Merge the prefixes that have the same values for the given attributes: duplicate, contained and adjacent networks
+# are replaced with the fewest CIDRs that cover the same addresses. The address ranges of each attribute set are
+# sorted, then swept once
+#
+def aggregate_prefixes(ranges, attributes):
+    groups = {}
+    for version, first, last, prefix in ranges:
+        key = tuple(prefix.get(attribute) for attribute in attributes) + (version, )
+        groups.setdefault(key, []).append((first, last))
+    aggregated_prefixes = []
+    for key in sorted(groups, key = lambda k: tuple('' if v is None else str(v) for v in k)):
+        merged_ranges = []
+        for first, last in sorted(groups[key]):
+            if merged_ranges and first <= merged_ranges[-1][1] + 1:
+                merged_ranges[-1][1] = max(merged_ranges[-1][1], last)
+            else:
+                merged_ranges.append([first, last])
+        version = key[-1]
+        for first, last in merged_ranges:
+            size = last - first + 1
+            if size & (size - 1) == 0 and first % size == 0:
+                # The range is a single CIDR
+                cidrs = ['%s/%d' % (IPAddress(first, version), address_bits[version] - size.bit_length() + 1)]
+            else:
+                cidrs = iprange_to_cidrs(IPAddress(first, version), IPAddress(last, version))
+            for cidr in cidrs:
+                prefix = dict((attribute, value) for attribute, value in zip(attributes, key) if value is not None)
+                prefix['ip_prefix'] = str(cidr)
+                aggregated_prefixes.append(prefix)
+    return aggregated_prefixes
+
+#
+# Find the prefixes of different accounts that overlap, as (prefix, locations, overlapping prefix, locations), where
+# locations are the accounts (and regions) that use a prefix. Identical ranges are grouped first and reported once,
+# with None as overlapping prefix when they are found in several accounts. Groups are then sorted by first address,
+# and each one is only compared with the groups that are still open at that address
+#
+def get_overlaps(ranges):
+    groups = OrderedDict()
+    for version, first, last, prefix in sorted(ranges, key = lambda r: (r[0], r[1], -r[2])):
+        group = groups.setdefault((version, first, last), {'ip_prefix': prefix['ip_prefix'], 'accounts': set(), 'locations': set()})
+        group['accounts'].add(prefix.get('account_id'))
+        region = prefix.get('region')
+        group['locations'].add('%s/%s' % (prefix.get('account_id'), region) if region else str(prefix.get('account_id')))
+    overlaps = []
+    open_groups = []
+    current_version = None
+    for index, ((version, first, last), group) in enumerate(groups.items()):
+        if version != current_version:
+            current_version = version
+            open_groups = []
+        while open_groups and open_groups[0][0] < first:
+            heapq.heappop(open_groups)
+        if len(group['accounts']) > 1:
+            overlaps.append((group['ip_prefix'], sorted(group['locations']), None, None))
+        for open_last, open_index, open_group in open_groups:
+            if len(open_group['accounts'] | group['accounts']) > 1:
+                overlaps.append((open_group['ip_prefix'], sorted(open_group['locations']), group['ip_prefix'], sorted(group['locations'])))
+        heapq.heappush(open_groups, (last, index, group))
+    return overlaps
+
 def new_ip_info(region, instance_id, is_elastic):
     ip_info = {}
     ip_info['region'] = region
@@ -68,6 +466,22 @@ def main():
                         default=[],
                         nargs='+',
                         help='Column number matching attributes when headers differ.')
+    parser.parser.add_argument('--validate-cidrs',
+                        dest='validate_cidrs',
+                        default=False,
+                        action='store_true',
+                        help='Skip CSV rows whose IP prefix is not a valid CIDR.')
+    parser.parser.add_argument('--normalize-cidrs',
+                        dest='normalize_cidrs',
+                        default=False,
+                        action='store_true',
+                        help='Rewrite CIDRs read from CSV files in canonical form (implies --validate-cidrs).')
+    parser.parser.add_argument('--aggregate',
+                        dest='aggregate',
+                        default=None,
+                        nargs='*',
+                        help='Merge duplicate, contained and adjacent prefixes that have the same values for these attributes '
+                             '(all prefixes if none is given), and report the prefixes of different accounts that overlap.')
     parser.parser.add_argument('--public-only',
                         dest='public_only',
                         default=False,
@@ -81,7 +495,17 @@ def main():
     parser.parser.add_argument('--output-format',
                                dest='output_format',
                                default='json',
-                               help='Format of the output (json or csv).')
+                               help='Format of the output (json, jsonl or csv).')
+    parser.parser.add_argument('--threads',
+                        dest='threads',
+                        default=10,
+                        type=int,
+                        help='Number of API calls made concurrently across profiles and regions.')
+    parser.parser.add_argument('--max-pending-regions',
+                        dest='max_pending_regions',
+                        default=20,
+                        type=int,
+                        help='Maximum number of regions fetched ahead of the writer (bounds memory usage).')
     args = parser.parse_args()
 
     # Configure the debug level
@@ -91,17 +515,76 @@ def main():
     if not check_requirements(os.path.realpath(__file__)):
         return 42
 
+    if args.threads < 1:
+        printError('Error: --threads must be at least 1.')
+        return 42
+
     # Initialize the list of regions to work with
     regions = build_region_list('ec2', args.regions, args.partition_name)
 
-    # For each profile/environment...
+    # For each profile/environment... (a profile found in both the credentials and config files is listed twice)
     profile_names = AWSProfiles.list(args.profile)
     if len(profile_names) == 0:
         profile_names = args.profile
+    profile_names = list(OrderedDict.fromkeys(profile_names))
+
+    # CSV mode: stream rows from the CSV files to the output file
+    if len(args.csv_ip_ranges) > 0 and not args.interactive:
+        for name in (['default'] if args.single_file else profile_names):
+            writer = IPRangesWriter(name, args.output_format, args.force_write, args.aggregate)
+            try:
+                prefixes = (prefix for filename in args.csv_ip_ranges for prefix in read_csv_prefixes(filename, args.attributes, args.mappings, args.skip_first_line))
+                if args.validate_cidrs or args.normalize_cidrs:
+                    prefixes = check_prefixes(prefixes, args.normalize_cidrs)
+                writer.write(unique_prefixes(prefixes))
+                writer.close()
+            except Exception as e:
+                printException(e)
+                writer.close(True)
+        return
 
     # Initialize the list of prefixes
     prefixes = []
 
+    # AWS mode: fetch the inventory of every profile and region concurrently, and write it as it arrives
+    if not args.interactive and not len(args.csv_ip_ranges):
+        profiles = {}
+        credentials = {}
+        for profile_name in profile_names:
+            try:
+                printInfo('Fetching IP information for the \'%s\' environment...' % profile_name)
+                profiles[profile_name] = AWSProfiles.get(profile_name)[0]
+                credentials[profile_name] = profiles[profile_name].get_credentials()
+                if not credentials[profile_name]['AccessKeyId']:
+                    return 42
+            except Exception as e:
+                printException(e)
+
+        # Write each (profile, region) as soon as it is complete; a profile's own file is only kept if all its regions were fetched
+        writer = IPRangesWriter('default', args.output_format, args.force_write, args.aggregate) if args.single_file else None
+        profile_writer = None
+        failed_profiles = set()
+        for profile_name, region, region_inventory, error in get_inventory(profile_names, credentials, regions, args.public_only, args.threads, args.max_pending_regions):
+            if not args.single_file and (not profile_writer or profile_writer.name != profile_name):
+                if profile_writer:
+                    profile_writer.close(profile_writer.name in failed_profiles)
+                profile_writer = IPRangesWriter(profile_name, args.output_format, args.force_write, args.aggregate)
+            if profile_name in failed_profiles:
+                continue
+            if error:
+                printException(error)
+                failed_profiles.add(profile_name)
+                continue
+            # Skip regions where the connection to EC2 failed
+            if region_inventory is None:
+                continue
+            (writer or profile_writer).write(get_region_prefixes(region_inventory, region, profiles[profile_name].account_id, args.public_only))
+        if profile_writer:
+            profile_writer.close(profile_writer.name in failed_profiles)
+        if writer:
+            writer.close()
+        return
+
     for profile_name in profile_names:
 
       try:
@@ -133,127 +616,6 @@ def main():
                     obj[a] = prompt_4_value('Enter the \'%s\' value:' % a)
                 prefixes.append(new_prefix(ip_prefix, obj))
 
-        # Support loading from CSV file
-        elif len(args.csv_ip_ranges) > 0:
-
-            # Load CSV file contents
-            for filename in args.csv_ip_ranges:
-                with open(filename, 'rt') as f:
-                    csv_contents = f.readlines()
-
-                # Initialize mappings
-                attributes = args.attributes
-                mappings = {}
-                if attributes == []:
-                    # Follow structure of first line
-                    headers = csv_contents.pop(0).strip().split(',')
-                    for index, attribute in enumerate(headers):
-                        mappings[attribute] = index
-                elif attributes and args.mappings == []:
-                    # Follow structure of first line but only map a subset of fields
-                    headers = csv_contents.pop(0).strip().split(',')
-                    attributes.append('ip_prefix')
-                    for attribute in set(attributes):
-                        mappings[attribute] = headers.index(attribute)
-                else:
-                    # Indices of columns are provided as an argument
-                    for index, attribute in enumerate(attributes):
-                        mappings[attribute] = int(args.mappings[index])
-                    if args.skip_first_line:
-                        csv_contents.pop(0)
-
-                # For each line...
-                for line in csv_contents:
-                    ip_prefix = {}
-                    values = line.strip().split(',')
-                    if len(values) < len(mappings):
-                        continue
-                    for attribute in mappings:
-                        ip_prefix[attribute] = values[mappings[attribute]]
-                    if 'ip_prefix' in mappings and 'mask' in mappings:
-                        ip = ip_prefix.pop('ip_prefix')
-                        mask = ip_prefix.pop('mask')
-                        ip_prefix['ip_prefix'] = '%s/%s' % (ip, mask.replace('/',''))
-                    prefixes.append(ip_prefix)
-
-        # AWS mode
-        else:
-
-            # Initialize IP addresses
-            printInfo('Fetching IP information for the \'%s\' environment...' % profile_name)
-            if not args.single_file:
-                prefixes = []
-            ip_addresses = {}
-
-            # Search for AWS credentials
-            profile = AWSProfiles.get(profile_name)[0]
-            credentials = profile.get_credentials()
-            if not credentials['AccessKeyId']:
-                return 42
-
-            # For each region...
-            for region in regions:
-
-                # Connect to EC2
-                ec2_client = connect_service('ec2', credentials, region)
-                if not ec2_client:
-                    continue
-
-                # Get public IP addresses associated with EC2 instances
-                printInfo('Fetching EC2 instances...')
-                reservations = handle_truncated_response(ec2_client.describe_instances, {}, ['Reservations'])
-                for reservation in reservations['Reservations']:
-                    for i in reservation['Instances']:
-                        if 'PublicIpAddress' in i:
-                            ip_addresses[i['PublicIpAddress']] = new_ip_info(region, i['InstanceId'], False)
-                            get_name(i, ip_addresses[i['PublicIpAddress']], 'InstanceId')
-                        if 'NetworkInterfaces' in i:
-                            for eni in i['NetworkInterfaces']:
-                                if 'Association' in eni:
-                                    ip_addresses[eni['Association']['PublicIp']] = new_ip_info(region, i['InstanceId'], False) # At that point, we don't know whether it's an EIP or not...
-                                    get_name(i, ip_addresses[eni['Association']['PublicIp']], 'InstanceId')
-
-                # Get all EIPs (to handle unassigned cases)
-                printInfo('Fetching Elastic IP addresses...')
-                eips = handle_truncated_response(ec2_client.describe_addresses, {}, ['Addresses'])
-                for eip in eips['Addresses']:
-                    instance_id = eip['InstanceId'] if 'InstanceId' in eip else None
-                    # EC2-Classic non associated EIPs have an empty string for instance ID (instead of lacking the attribute in VPC)
-                    if instance_id == '':
-                        instance_id = None
-                    ip_addresses[eip['PublicIp']] = new_ip_info(region, instance_id, True)
-                    ip_addresses[eip['PublicIp']]['name'] = instance_id
-
-                # Format
-                for ip in ip_addresses:
-                    prefix = new_prefix(ip, ip_addresses[ip])
-                    prefix['account_id'] = profile.account_id
-                    prefixes.append(prefix)
-
-                if not args.public_only:
-
-                    # Get all VPCs
-                    printInfo('Fetching VPCs...')
-                    vpcs = ec2_client.describe_vpcs()['Vpcs']
-                    for vpc in vpcs:
-                        prefix = new_prefix(vpc['CidrBlock'], {})
-                        prefix['id'] = vpc['VpcId']
-                        prefix['name'] = get_name(vpc, {}, 'VpcId')
-                        prefix['region'] = region
-                        prefix['account_id'] = profile.account_id
-                        prefixes.append(prefix)
-
-                    # Get all Subnets
-                    printInfo('Fetching subnets...')
-                    subnets = ec2_client.describe_subnets()['Subnets']
-                    for subnet in subnets:
-                        prefix = new_prefix(subnet['CidrBlock'], {})
-                        prefix['id'] = subnet['SubnetId']
-                        prefix['name'] = get_name(subnet, {}, 'SubnetId')
-                        prefix['region'] = region
-                        prefix['account_id'] = profile.account_id
-                        prefixes.append(prefix)
-
         if not args.single_file:
             # Generate an ip-ranges-<profile>.json file
             save_ip_ranges(profile_name, prefixes, args.force_write, args.debug, args.output_format)
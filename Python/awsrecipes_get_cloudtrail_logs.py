@@ -6,32 +6,96 @@ import os
 import sys
 
 from opinel.services.s3 import get_s3_bucket_location
-from opinel.utils.aws import connect_service, build_region_list, get_aws_account_id, handle_truncated_response
+from opinel.utils.aws import connect_service, build_region_list
 from opinel.utils.cli_parser import OpinelArgumentParser
-from opinel.utils.console import configPrintException, printError, printException, printInfo
+from opinel.utils.console import configPrintException, printDebug, printError, printException, printInfo
 from opinel.utils.credentials import read_creds
-from opinel.utils.globals import check_requirements, manage_dictionary
-from opinel.utils.threads import thread_work
+from opinel.utils.globals import check_requirements
 
 
 # Import stock packages
+import codecs
 import datetime
 from datetime import date, timedelta
+import fnmatch
+import functools
 import gzip
+import json
 import os
-from threading import Thread
+import tempfile
+import time
+import zlib
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from collections import OrderedDict
+from netaddr import IPAddress, IPNetwork
+from threading import Lock, RLock, Thread
 # Python2 vs Python3
 try:
     from Queue import Queue
 except ImportError:
     from queue import Queue
 
+# Optional output formats
+_zstandard_available = True
+try:
+    import zstandard
+except ImportError:
+    _zstandard_available = False
+_pyarrow_available = True
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    _pyarrow_available = False
+
 ########################################
 ##### Globals
 ########################################
 
 cloudtrail_log_path = 'AWSLogs/AWS_ACCOUNT_ID/CloudTrail/REGION/'
+re_account_id = re.compile(r'^\d{12}$')
+re_organization_id = re.compile(r'^o-[a-z0-9]{10,32}$')
 download_folder = 'trails'
+chunk_size = 1024 * 1024
+list_threads = 16
+download_threads = 100
+decompress_threads = 30
+
+# S3 transfers: log files are small, only large objects are worth a multipart download with threads of its own
+multipart_threshold = 64 * 1024 * 1024
+small_object_transfer = TransferConfig(multipart_threshold = multipart_threshold, use_threads = False)
+large_object_transfer = TransferConfig(multipart_threshold = multipart_threshold, multipart_chunksize = 16 * 1024 * 1024, max_concurrency = 8)
+
+# Time window
+re_key_timestamp = re.compile(r'_CloudTrail_[a-z0-9-]+_(\d{8}T\d{4}Z)_')
+key_timestamp_format = '%Y%m%dT%H%MZ'
+event_time_format = '%Y-%m-%dT%H:%M:%SZ'
+date_formats = ['%Y/%m/%d', '%Y-%m-%d']
+time_formats = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%MZ', '%Y-%m-%dT%H:%M']
+# Log files are named after their delivery time, which follows the events they contain by up to about 15 minutes
+delivery_delay = timedelta(hours = 1)
+
+# Partitioned output
+output_formats = ['json', 'jsonl.gz', 'jsonl.zst', 'parquet']
+re_log_filename = re.compile(r'^(\d{12})_CloudTrail_([a-z0-9-]+)_(\d{4})(\d{2})(\d{2})T\d{4}Z_')
+partition_folders = ['account=%s', 'region=%s', 'date=%s']
+max_open_partitions = 64
+record_batch_size = 1000
+re_whitespace = re.compile(r'[ \t\n\r]*')
+parquet_row_group_size = 10000
+parquet_columns = [
+    ('event_time', ['eventTime']),
+    ('event_name', ['eventName']),
+    ('event_source', ['eventSource']),
+    ('aws_region', ['awsRegion']),
+    ('source_ip_address', ['sourceIPAddress']),
+    ('user_arn', ['userIdentity', 'arn']),
+    ('user_agent', ['userAgent']),
+    ('error_code', ['errorCode']),
+    ('event_id', ['eventID']),
+    ('recipient_account_id', ['recipientAccountId']),
+]
 
 
 
@@ -47,44 +111,804 @@ def show_current_count():
 show_current_count.counter = 0
 
 
+def gunzip_chunks(src):
+    """
+    Decompress a gzip stream chunk by chunk, so that memory usage does not depend on the size of the file. Raises
+    EOFError when the stream is truncated, once the data that could be decompressed has been yielded
+
+    :param src:                         File-like object to read compressed data from (local file or S3 object body)
+    :return:                            Generator of decompressed data
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    empty = True
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        empty = False
+        while chunk:
+            yield decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+            # Concatenated gzip members
+            if decompressor.unused_data:
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # zlib does not complain about a truncated stream, the end-of-stream marker of the last member is just missing
+    if not empty and not is_end_of_stream(decompressor):
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    yield decompressor.flush()
+
+
+def is_end_of_stream(decompressor):
+    """
+    Determine whether a decompressor reached the end of its stream
+
+    :param decompressor:                zlib decompression object
+    """
+    try:
+        return decompressor.eof
+    except AttributeError:
+        # Python 2: data fed after the end of the stream is left unused
+        probe = decompressor.copy()
+        try:
+            probe.decompress(b'\0')
+        except zlib.error:
+            return False
+        return probe.unused_data == b'\0'
+
+
+def gunzip_stream(src, dst):
+    """
+    Decompress a gzip stream to a file-like object
+
+    :param src:                         File-like object to read compressed data from (local file or S3 object body)
+    :param dst:                         File-like object to write decompressed data to
+    """
+    for data in gunzip_chunks(src):
+        dst.write(data)
+
+
+class RecordReader(object):
+    """
+    Parse the records of a log file ({"Records": [...]}) as it is decompressed, so that only one batch of records is
+    held in memory at a time
+
+    :param chunks:                      Decompressed data, as an iterable of byte strings
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.size = 0
+
+    def batches(self, batch_size):
+        self.expect('{')
+        if self.skip_whitespace() == '}':
+            self.position += 1
+        else:
+            while True:
+                key = self.read_value()
+                self.expect(':')
+                if key == 'Records':
+                    self.expect('[')
+                    batch = []
+                    if self.skip_whitespace() == ']':
+                        self.position += 1
+                    else:
+                        while True:
+                            batch.append(self.read_value())
+                            if len(batch) >= batch_size:
+                                yield batch
+                                batch = []
+                            if self.skip_whitespace() == ']':
+                                self.position += 1
+                                break
+                            self.expect(',')
+                    if batch:
+                        yield batch
+                else:
+                    self.read_value()
+                if self.skip_whitespace() == '}':
+                    self.position += 1
+                    break
+                self.expect(',')
+        # Read the rest of the file: only trailing whitespace is allowed, and a truncated gzip stream is reported at its end
+        if self.skip_whitespace():
+            raise ValueError('Unexpected data after the records at offset %d' % self.position)
+
+    def read_more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.text_decoder.decode(b'', True)
+        else:
+            self.size += len(chunk)
+            text = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.position = re_whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return ''
+            self.read_more()
+
+    def expect(self, character):
+        if self.skip_whitespace() != character:
+            raise ValueError('Expected %s at offset %d of the records' % (character, self.position))
+        self.position += 1
+
+    def read_value(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                # A value that reaches the end of the buffer may be truncated (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+class Countdown(object):
+    """
+    Call a function once all the parts of a log file are stored
+
+    :param callback:                    Function to call
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.count = 1
+        self.lock = Lock()
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+        return self.release
+
+    def release(self):
+        with self.lock:
+            self.count -= 1
+            done = self.count == 0
+        if done:
+            self.callback()
+
+
+class S3ClientPool(object):
+    """
+    S3 clients shared by the workers of the pipeline, one per region
+
+    Clients are thread-safe; what serializes the workers is the connection pool of each client (10 connections by
+    default), so it is sized to the number of workers and connections are kept alive.
+
+    :param credentials:                 AWS credentials
+    :param max_connections:             Size of the connection pool of each client
+    """
+    def __init__(self, credentials, max_connections):
+        self.credentials = credentials
+        self.max_connections = max_connections
+        self.config = Config(max_pool_connections = max_connections, tcp_keepalive = True)
+        self.lock = Lock()
+        self.clients = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def get(self, region):
+        with self.lock:
+            if region not in self.clients:
+                self.clients[region] = connect_service('s3', self.credentials, region, config = self.config)
+            return self.clients[region]
+
+    def start_transfer(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def end_transfer(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def print_stats(self):
+        printDebug('Peak concurrent S3 transfers: %d (connection pools of %d)' % (self.peak_in_flight, self.max_connections))
+        for region in sorted(self.clients):
+            try:
+                pools = self.clients[region]._endpoint.http_session._manager.pools
+                for pool_key in pools.keys():
+                    pool = pools[pool_key]
+                    printDebug('S3 connections to %s: %d opened for %d requests' % (pool.host, pool.num_connections, pool.num_requests))
+            except Exception:
+                printDebug('No connection statistics for the S3 client in %s' % region)
+
+
+class StageStats(object):
+    """
+    Throughput counters of a stage of the download pipeline
+
+    :param name:                        Name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.objects = 0
+        self.bytes = 0
+        self.start = None
+        self.end = None
+
+    def begin(self):
+        with self.lock:
+            if self.start is None:
+                self.start = time.time()
+
+    def add(self, size):
+        with self.lock:
+            self.objects += 1
+            self.bytes += size
+            self.end = time.time()
+
+    def report(self):
+        elapsed = (self.end - self.start) if self.objects else 0
+        mb = self.bytes / 1024.0 / 1024.0
+        printInfo('%-10s %6d objects, %9.1f MB in %6.1fs (%.1f MB/s, %.1f objects/s)' %
+                  (self.name, self.objects, mb, elapsed, mb / elapsed if elapsed else 0, self.objects / elapsed if elapsed else 0))
+
+
+class DownloadManifest(object):
+    """
+    Record of the objects already fetched, so that an interrupted pull resumes without requests to S3 or file checks
+
+    The manifest is stored as JSON lines (bucket, key, ETag, size, status and output fingerprint) in the download folder.
+    Each update is appended as a new line, the last line of an object wins; the manifest is compacted when saved,
+    through a temporary file and a rename so that an interruption never leaves it truncated.
+
+    :param folder:                      Download folder
+    :param filters:                     Fingerprint of the record filters and output of this run (get_output_fingerprint)
+    """
+    def __init__(self, folder, filters = None):
+        self.folder = folder
+        self.filters = filters
+        self.path = os.path.join(folder, '.manifest.jsonl')
+        self.lock = Lock()
+        self.entries = {}
+        self.filenames = {}
+        self.journal = None
+        self.updates = 0
+        self.skipped = 0
+        if os.path.isfile(self.path):
+            with open(self.path, 'rt') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[(entry['bucket'], entry['key'])] = entry
+                        if entry['status'] == 'downloaded':
+                            self.filenames[os.path.join(folder, entry['key'].split('/')[-1])] = (entry['bucket'], entry['key'])
+                        else:
+                            self.filenames.pop(os.path.join(folder, entry['key'].split('/')[-1]), None)
+                    except Exception as e:
+                        printException(e)
+
+    def is_complete(self, bucket_name, key, etag, size, filename, dst):
+        """
+        Determine whether an object was already fetched; the local files are only checked for interrupted objects
+        """
+        entry = self.entries.get((bucket_name, key))
+        if entry and entry['etag'] == etag and entry['size'] == size:
+            if entry['status'] == 'done':
+                # Objects whose records were filtered or written differently have to be fetched again
+                complete = entry.get('filters') == self.filters
+            elif os.path.exists(filename) and os.path.getsize(filename) == size:
+                # Downloaded, decompression still pending
+                complete = True
+            elif os.path.exists(dst) and os.path.getsize(dst) > 0:
+                self.update(bucket_name, key, etag, size, 'done')
+                complete = True
+            else:
+                complete = False
+        elif not entry and os.path.exists(dst) and os.path.getsize(dst) > 0:
+            # Files fetched before the manifest existed
+            self.update(bucket_name, key, etag, size, 'done')
+            complete = True
+        elif not entry and os.path.exists(filename) and os.path.getsize(filename) == size:
+            self.update(bucket_name, key, etag, size, 'downloaded', filename)
+            complete = True
+        else:
+            complete = False
+        if complete:
+            with self.lock:
+                self.skipped += 1
+        return complete
+
+    def update(self, bucket_name, key, etag, size, status, filename = None):
+        with self.lock:
+            entry = {'bucket': bucket_name, 'key': key, 'etag': etag, 'size': size, 'status': status, 'filters': self.filters}
+            self.entries[(bucket_name, key)] = entry
+            if filename:
+                self.filenames[filename] = (bucket_name, key)
+            self.__append(entry)
+
+    def set_decompressed(self, filename):
+        with self.lock:
+            entry_key = self.filenames.pop(filename, None)
+            if entry_key in self.entries:
+                self.entries[entry_key]['status'] = 'done'
+                self.__append(self.entries[entry_key])
+
+    def save(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+            fd, tmp_path = tempfile.mkstemp(dir = self.folder, suffix = '.tmp')
+            with os.fdopen(fd, 'wt') as f:
+                for entry_key in sorted(self.entries):
+                    f.write('%s\n' % json.dumps(self.entries[entry_key], sort_keys = True))
+            os.rename(tmp_path, self.path)
+
+    def __append(self, entry):
+        if not self.journal:
+            # An interrupted run may have left a partial last line
+            partial_line = False
+            if os.path.isfile(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    partial_line = f.read(1) != b'\n'
+            self.journal = open(self.path, 'at')
+            if partial_line:
+                self.journal.write('\n')
+        self.journal.write('%s\n' % json.dumps(entry, sort_keys = True))
+        self.journal.flush()
+        self.updates += 1
+
+
+class RecordFilter(object):
+    """
+    Select log records by event name, event source, principal ARN or source IP address. Values may contain shell-style
+    wildcards; source IP addresses may also be CIDR blocks.
+
+    :param event_names:                 Event names (e.g. ConsoleLogin)
+    :param event_sources:               Event sources (e.g. iam.amazonaws.com)
+    :param principals:                  ARNs of the principals (userIdentity.arn)
+    :param source_ips:                  Source IP addresses
+    :param time_window:                 Earliest and latest event times (YYYY-MM-DDTHH:MM:SSZ)
+    """
+    def __init__(self, event_names, event_sources, principals, source_ips, time_window = None):
+        self.filters = [(path, patterns) for path, patterns in [(['eventName'], event_names), (['eventSource'], event_sources),
+                                                                (['userIdentity', 'arn'], principals), (['sourceIPAddress'], source_ips)] if patterns]
+        self.time_window = time_window
+        self.networks = [IPNetwork(source_ip) for source_ip in source_ips if '/' in source_ip]
+        self.lock = Lock()
+        self.scanned = 0
+        self.kept = 0
+
+    def get_fingerprint(self):
+        if self.time_window:
+            return json.dumps({'filters': self.filters, 'time_window': self.time_window}, sort_keys = True)
+        return json.dumps(self.filters, sort_keys = True) if self.filters else None
+
+    def filter(self, records):
+        kept_records = [record for record in records if self.matches(record)]
+        with self.lock:
+            self.scanned += len(records)
+            self.kept += len(kept_records)
+        return kept_records
+
+    def matches(self, record):
+        if self.time_window and not (self.time_window[0] <= record.get('eventTime', '') <= self.time_window[1]):
+            return False
+        for path, patterns in self.filters:
+            value = record
+            for attribute in path:
+                value = value.get(attribute) if type(value) == dict else None
+            if value is None:
+                return False
+            if not any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns) and not (path == ['sourceIPAddress'] and self.in_networks(value)):
+                return False
+        return True
+
+    def in_networks(self, source_ip):
+        try:
+            ip = IPAddress(source_ip)
+        except Exception:
+            # Calls made by AWS services have the service name as source
+            return False
+        return any(ip in network for network in self.networks)
+
+
+class PartitionFile(object):
+    """
+    Output file of a partition, written to a temporary file that is renamed once the file is complete. Writes to the
+    file, and closing it, are serialized by its own lock
+
+    :param folder:                      Folder of the partition
+    :param part:                        Number of the file in the partition
+    :param output_format:               One of jsonl.gz, jsonl.zst or parquet
+    """
+    def __init__(self, folder, part, output_format):
+        self.output_format = output_format
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.path = os.path.join(folder, 'part-%05d.%s' % (part, output_format))
+        fd, self.tmp_path = tempfile.mkstemp(dir = folder, prefix = '.part-', suffix = '.tmp')
+        self.raw = os.fdopen(fd, 'wb')
+        self.rows = []
+        self.callbacks = []
+        self.lock = RLock()
+        self.closed = False
+        if output_format == 'jsonl.gz':
+            self.writer = gzip.GzipFile(fileobj = self.raw, mode = 'wb')
+        elif output_format == 'jsonl.zst':
+            self.writer = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.writer = pyarrow.parquet.ParquetWriter(self.raw, get_parquet_table([]).schema)
+
+    def write(self, records):
+        if self.output_format == 'parquet':
+            self.rows += records
+            if len(self.rows) >= parquet_row_group_size:
+                self.writer.write_table(get_parquet_table(self.rows))
+                self.rows = []
+        else:
+            for record in records:
+                self.writer.write((json.dumps(record) + '\n').encode('utf-8'))
+
+    def size(self):
+        return self.raw.tell()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.rows:
+                self.writer.write_table(get_parquet_table(self.rows))
+            self.writer.close()
+            if not self.raw.closed:
+                self.raw.close()
+            os.rename(self.tmp_path, self.path)
+            # Records are only safe once the file is renamed
+            for callback in self.callbacks:
+                callback()
+
+
+class PartitionWriter(object):
+    """
+    Write log records to files partitioned by account, region and date, rolled over when they reach the target size.
+    The writer's lock only guards the set of open files; records are encoded under the lock of their partition file
+
+    :param folder:                      Output folder
+    :param output_format:               One of jsonl.gz, jsonl.zst or parquet
+    :param target_size:                 Size of the output files, in bytes
+    """
+    def __init__(self, folder, output_format, target_size):
+        self.folder = folder
+        self.output_format = output_format
+        self.target_size = target_size
+        self.lock = Lock()
+        self.files = OrderedDict()
+        self.parts = {}
+
+    def write(self, partition, records, callback):
+        while True:
+            evicted_files = []
+            with self.lock:
+                # Least recently used partitions are closed first
+                partition_file = self.files.pop(partition, None)
+                if not partition_file:
+                    folder = os.path.join(self.folder, *[partition_folder % value for partition_folder, value in zip(partition_folders, partition)])
+                    # Part numbers are allocated here, as previous files may not be renamed yet
+                    if partition not in self.parts:
+                        parts = [int(f.split('.')[0][len('part-'):]) for f in os.listdir(folder) if f.startswith('part-')] if os.path.isdir(folder) else []
+                        self.parts[partition] = max(parts) + 1 if parts else 0
+                    partition_file = PartitionFile(folder, self.parts[partition], self.output_format)
+                    self.parts[partition] += 1
+                self.files[partition] = partition_file
+                while len(self.files) > max_open_partitions:
+                    evicted_files.append(self.files.popitem(last = False)[1])
+            for evicted_file in evicted_files:
+                evicted_file.close()
+            with partition_file.lock:
+                # The file may have been rolled over or evicted in the meantime
+                if partition_file.closed:
+                    continue
+                partition_file.write(records)
+                partition_file.callbacks.append(callback)
+                if partition_file.size() >= self.target_size:
+                    with self.lock:
+                        if self.files.get(partition) is partition_file:
+                            self.files.pop(partition)
+                    partition_file.close()
+                return
+
+    def close(self):
+        with self.lock:
+            partition_files = list(self.files.values())
+            self.files.clear()
+        for partition_file in partition_files:
+            partition_file.close()
+
+#
+# Fingerprint of the records kept by a run and of where they are written, stored in the manifest. Plain log files keep
+# the fingerprint of their record filters, so that manifests of previous versions stay valid
+#
+def get_output_fingerprint(record_filter, output_format):
+    filters = record_filter.get_fingerprint() if record_filter else None
+    if output_format == 'json':
+        return filters
+    return json.dumps({'filters': filters, 'output_format': output_format, 'partition_folders': partition_folders}, sort_keys = True)
+
+#
+# Flatten log records into a table with a fixed schema; the complete record is kept as JSON
+#
+def get_parquet_table(records):
+    columns = []
+    for name, path in parquet_columns:
+        values = []
+        for record in records:
+            value = record
+            for attribute in path:
+                value = value.get(attribute) if type(value) == dict else None
+            values.append(value if value is None or type(value) == str else json.dumps(value))
+        columns.append(pyarrow.array(values, type = pyarrow.string()))
+    columns.append(pyarrow.array([json.dumps(record) for record in records], type = pyarrow.string()))
+    return pyarrow.Table.from_arrays(columns, names = [name for name, path in parquet_columns] + ['record'])
+
+#
+# Get the account, region and date of a log file from its name (<account_id>_CloudTrail_<region>_<YYYYMMDD>T<HHMM>Z_...)
+#
+def get_partition(filename):
+    match = re_log_filename.match(os.path.basename(filename))
+    if not match:
+        raise Exception('Unexpected log file name: %s' % filename)
+    return match.group(1), match.group(2), '%s-%s-%s' % match.group(3, 4, 5)
+
+#
+# Parse a --from/--to value, either a date (YYYY/MM/DD or YYYY-MM-DD) or a UTC timestamp (YYYY-MM-DDTHH:MM[:SS][Z]).
+# Returns the time and whether it was more precise than a day
+#
+def parse_time(value, end_of_day = False):
+    for time_format in time_formats:
+        try:
+            return datetime.datetime.strptime(value, time_format), True
+        except ValueError:
+            pass
+    for date_format in date_formats:
+        try:
+            day = datetime.datetime.strptime(value, date_format)
+            return (day + timedelta(days = 1, seconds = -1) if end_of_day else day), False
+        except ValueError:
+            pass
+    raise ValueError('Invalid date or time: %s' % value)
+
+#
+# Save the records of a log file: as is, filtered, or to the partitioned output. Records are read in batches as the
+# file is decompressed. The done callback is called once the records are safely stored
+#
+def save_log_file(src, dst, params, done):
+    record_filter = params['Filter']
+    writer = params['Writer']
+    if not writer and not record_filter:
+        write_atomically(dst, lambda f: gunzip_stream(src, f))
+        done()
+        return os.path.getsize(dst)
+    reader = RecordReader(gunzip_chunks(src))
+    batches = reader.batches(record_batch_size)
+    if record_filter:
+        batches = (record_filter.filter(records) for records in batches)
+    if writer:
+        # The records of a log file may end up in several partition files
+        countdown = Countdown(done)
+        for records in spool_records(batches, os.path.dirname(dst) or '.'):
+            writer.write(get_partition(dst), records, countdown.add())
+        countdown.release()
+    else:
+        count = [0]
+        def write_records(f):
+            f.write(b'{"Records": [')
+            for records in batches:
+                for record in records:
+                    f.write(((', ' if count[0] else '') + json.dumps(record)).encode('utf-8'))
+                    count[0] += 1
+            f.write(b']}')
+        write_atomically(dst, write_records)
+        if not count[0]:
+            os.remove(dst)
+        done()
+    return reader.size
+
+#
+# Spool the records of a log file to an anonymous temporary file, and read them back in batches once the whole file
+# was parsed: a log file that fails part way (e.g. a truncated download) leaves nothing in the partitioned output, and
+# can be retried
+#
+def spool_records(batches, folder):
+    spool = tempfile.TemporaryFile(dir = folder)
+    try:
+        for records in batches:
+            for record in records:
+                spool.write((json.dumps(record) + '\n').encode('utf-8'))
+        spool.seek(0)
+        records = []
+        for line in spool:
+            records.append(json.loads(line.decode('utf-8')))
+            if len(records) >= record_batch_size:
+                yield records
+                records = []
+        if records:
+            yield records
+    finally:
+        spool.close()
+
+#
+# List the "folders" directly under a prefix
+#
+def list_common_prefixes(s3_client, bucket_name, prefix):
+    common_prefixes = []
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'Delimiter': '/'}
+    while True:
+        response = s3_client.list_objects_v2(**params)
+        common_prefixes += [p['Prefix'] for p in response.get('CommonPrefixes', [])]
+        if not response.get('IsTruncated', False):
+            break
+        params['ContinuationToken'] = response['NextContinuationToken']
+    return common_prefixes
+
+#
+# Find the accounts that deliver logs under a trail's prefix, either AWSLogs/<account_id>/ or, for organization
+# trails, AWSLogs/<organization_id>/<account_id>/
+#
+def get_account_paths(s3_client, bucket_name, prefix, account_ids):
+    account_paths = []
+    for path in list_common_prefixes(s3_client, bucket_name, os.path.join(prefix, 'AWSLogs/')):
+        name = path.rstrip('/').split('/')[-1]
+        if re_account_id.match(name):
+            account_paths.append(name)
+        elif re_organization_id.match(name):
+            for account_path in list_common_prefixes(s3_client, bucket_name, path):
+                account_id = account_path.rstrip('/').split('/')[-1]
+                if re_account_id.match(account_id):
+                    account_paths.append('%s/%s' % (name, account_id))
+    if account_ids:
+        account_paths = [account_path for account_path in account_paths if account_path.split('/')[-1] in account_ids]
+    return account_paths
+
+#
+# Group trails by the S3 location (bucket and prefix) of their logs; multi-region and organization trails show up in
+# every region, and several trails may deliver to the same location
+#
+def get_trail_locations(trails):
+    trail_locations = OrderedDict()
+    for trail in trails:
+        location = (trail['S3BucketName'], trail['S3KeyPrefix'] if 'S3KeyPrefix' in trail else '')
+        if location not in trail_locations:
+            trail_locations[location] = []
+        if trail['Name'] not in trail_locations[location]:
+            trail_locations[location].append(trail['Name'])
+    return trail_locations
+
+
+def start_stage(function, params, num_threads, maxsize = 0):
+    q = Queue(maxsize = maxsize)
+    for i in range(num_threads):
+        worker = Thread(target = function, args = (q, params))
+        worker.daemon = True
+        worker.start()
+    return q
+
+
+def list_objects(q, params):
+    stats = params['Stats']
+    while True:
+        s3_client, bucket_name, prefix, start_after = q.get()
+        stats['list'].begin()
+        try:
+            # Paginate with StartAfter so that keys reach the download queue page by page. Keys of a daily folder are
+            # sorted by delivery time, so listing stops at the first one delivered after the time window
+            last_timestamp = params['LastKeyTimestamp']
+            done = False
+            while not done:
+                response = s3_client.list_objects_v2(Bucket = bucket_name, Prefix = prefix, StartAfter = start_after)
+                for o in response.get('Contents', []):
+                    match = re_key_timestamp.search(o['Key'])
+                    if last_timestamp and match and match.group(1) > last_timestamp:
+                        done = True
+                        break
+                    params['DownloadQueue'].put((s3_client, bucket_name, o['Key'], o['ETag'], o['Size']))
+                    stats['list'].add(o['Size'])
+                    start_after = o['Key']
+                if not response.get('IsTruncated', False) or not start_after:
+                    break
+        except Exception as e:
+            printException(e)
+            printInfo('Error listing %s; skipped.' % prefix)
+        finally:
+            q.task_done()
+
+
 def download_object(q, params):
-    bucket_name = params['Bucket']
-    s3_client = params['S3Client']
+    stats = params['Stats']
+    manifest = params['Manifest']
     while True:
-        key, tries = q.get()
+        s3_client, bucket_name, key, etag, size = q.get()
+        stats['download'].begin()
         filename = os.path.join(download_folder, key.split('/')[-1])
         dst = re.sub(r'\.(\w*)?$', '', filename)
-        if (not os.path.exists(filename) and not os.path.exists(dst)) or (os.path.exists(filename) and os.path.getsize(filename) == 0) or (os.path.exists(dst) and os.path.getsize(dst) == 0):
-            try:
-                s3_client.download_file(bucket_name, key, filename)
-            except Exception as e:
-                if tries < 2:
-                    q.put([key, tries + 1])
-                    printInfo('Error downloading %s; re-queued.' % filename)
-                else:
-                    printException(e)
-                    printInfo('Error downloading %s; discarded.' % filename)
+        if not manifest.is_complete(bucket_name, key, etag, size, filename, dst):
+            # Retry in place: re-queuing could block forever on a full queue
+            for tries in range(3):
+                try:
+                    if params['Stream'] and filename.endswith('.gz'):
+                        # Decompress the object as it is downloaded, the .gz file never touches the disk
+                        params['S3ClientPool'].start_transfer()
+                        try:
+                            s3_object = s3_client.get_object(Bucket = bucket_name, Key = key)
+                            stats['decompress'].begin()
+                            decompressed_size = save_log_file(s3_object['Body'], dst, params, functools.partial(manifest.update, bucket_name, key, etag, size, 'done'))
+                        finally:
+                            params['S3ClientPool'].end_transfer()
+                        stats['download'].add(s3_object.get('ContentLength', 0))
+                        stats['decompress'].add(decompressed_size)
+                    else:
+                        params['S3ClientPool'].start_transfer()
+                        try:
+                            s3_client.download_file(bucket_name, key, filename, Config = large_object_transfer if size >= multipart_threshold else small_object_transfer)
+                        finally:
+                            params['S3ClientPool'].end_transfer()
+                        stats['download'].add(os.path.getsize(filename))
+                        # Hand the file over to the decompression stage right away; blocks while that stage is saturated
+                        if filename.endswith('.gz'):
+                            manifest.update(bucket_name, key, etag, size, 'downloaded', filename)
+                            params['DecompressQueue'].put(filename)
+                        else:
+                            manifest.update(bucket_name, key, etag, size, 'done')
+                    break
+                except Exception as e:
+                    if tries < 2:
+                        printInfo('Error downloading %s; retrying.' % filename)
+                    else:
+                        printException(e)
+                        printInfo('Error downloading %s; discarded.' % filename)
         q.task_done()
         #show_current_count()
 
 def gunzip_file(q, params):
+    stats = params['Stats']
     while True:
         src = q.get()
-        src = os.path.join(download_folder, src)
+        stats['decompress'].begin()
         try:
             dst = re.sub(r'\.(\w*)?$', '', src)
             if src.endswith('.gz'):
-              with gzip.open(src, 'rb') as f1:
-                file_contents = f1.read()
-                with open(dst, 'wt') as f2:
-                    f2.write(file_contents)
+              with open(src, 'rb') as f:
+                decompressed_size = save_log_file(f, dst, params, functools.partial(params['Manifest'].set_decompressed, src))
               os.remove(src)
+              stats['decompress'].add(decompressed_size)
         except Exception as e:
             printException(e)
             pass
         finally:
             q.task_done()
 
+#
+# Write a file through a temporary file in the same folder, so that an interrupted write never leaves a partial file
+#
+def write_atomically(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path) or '.', suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
 
 
 ########################################
@@ -104,17 +928,52 @@ def main():
                                 dest='aws_account_id',
                                 default=[ None ],
                                 nargs='+',
-                                help='Bleh.')
+                                help='Only download the logs of these accounts (defaults to all accounts found in the trails\' buckets).')
     parser.parser.add_argument('--from',
                                 dest='from_date',
                                 default=[ None ],
                                 nargs='+',
-                                help='Bleh.')
+                                help='First day (YYYY/MM/DD), or start of the time window (YYYY-MM-DDTHH:MM:SSZ).')
     parser.parser.add_argument('--to',
                                 dest='to_date',
                                 default=[ None ],
                                 nargs='+',
-                                help='Bleh.')
+                                help='Last day (YYYY/MM/DD), or end of the time window (YYYY-MM-DDTHH:MM:SSZ).')
+    parser.parser.add_argument('--stream',
+                                dest='stream',
+                                default=False,
+                                action='store_true',
+                                help='Decompress log files as they are downloaded instead of saving the .gz files first.')
+    parser.parser.add_argument('--event-name',
+                                dest='event_name',
+                                default=[],
+                                nargs='+',
+                                help='Only keep the records of these events (e.g. ConsoleLogin, AssumeRole, Delete*).')
+    parser.parser.add_argument('--event-source',
+                                dest='event_source',
+                                default=[],
+                                nargs='+',
+                                help='Only keep the records of events from these services (e.g. iam.amazonaws.com).')
+    parser.parser.add_argument('--principal',
+                                dest='principal',
+                                default=[],
+                                nargs='+',
+                                help='Only keep the records of events performed by these principals (ARN, e.g. arn:aws:iam::*:user/alice).')
+    parser.parser.add_argument('--source-ip',
+                                dest='source_ip',
+                                default=[],
+                                nargs='+',
+                                help='Only keep the records of events originating from these IP addresses or CIDR blocks.')
+    parser.parser.add_argument('--output-format',
+                                dest='output_format',
+                                default='json',
+                                choices=output_formats,
+                                help='Write one JSON file per log file (default), or write the records to compressed JSON lines or Parquet files partitioned by account, region and date.')
+    parser.parser.add_argument('--target-size',
+                                dest='target_size',
+                                default=128,
+                                type=int,
+                                help='Size of the partitioned output files, in MB.')
 
     args = parser.parse_args()
 
@@ -130,14 +989,18 @@ def main():
     # Arguments
     profile_name = args.profile[0]
     try:
-        from_date = datetime.datetime.strptime(args.from_date[0], "%Y/%m/%d").date()
-        to_date = datetime.datetime.strptime(args.to_date[0], "%Y/%m/%d").date()
-        delta = to_date - from_date
+        from_time, from_precise = parse_time(args.from_date[0])
+        to_time, to_precise = parse_time(args.to_date[0], True)
     except Exception as e:
         printException(e)
-        printError('Error: dates must be formatted of the following format YYYY/MM/DD')
+        printError('Error: dates must be formatted as YYYY/MM/DD, or as YYYY-MM-DDTHH:MM:SSZ for a time window')
         return 42
-    if delta.days < 0:
+    # With a time window, keys are pruned by delivery time and records by event time; days are downloaded whole
+    time_window = (from_time.strftime(event_time_format), to_time.strftime(event_time_format)) if from_precise or to_precise else None
+    last_delivery_time = to_time + delivery_delay if time_window else to_time
+    from_date = from_time.date()
+    delta = last_delivery_time.date() - from_date
+    if to_time < from_time:
         printError('Error: your \'to\' date is earlier than your \'from\' date')
         return 42
 
@@ -146,66 +1009,99 @@ def main():
     if not credentials['AccessKeyId']:
         return 42
 
-    # Fetch AWS account ID
-    if not args.aws_account_id[0]:
-        printInfo('Fetching the AWS account ID...')
-        aws_account_id = get_aws_account_id(credentials)
-    else:
-        aws_account_id = args.aws_account_id[0]
-    global cloudtrail_log_path
-    cloudtrail_log_path = cloudtrail_log_path.replace('AWS_ACCOUNT_ID', aws_account_id)
+    # Check that the output format is supported
+    if args.output_format == 'jsonl.zst' and not _zstandard_available:
+        printError('Error: the zstandard package is required to write %s files.' % args.output_format)
+        return 42
+    if args.output_format == 'parquet' and not _pyarrow_available:
+        printError('Error: the pyarrow package is required to write %s files.' % args.output_format)
+        return 42
 
     # Create download dir
     if not os.path.exists(download_folder):
         os.makedirs(download_folder)
 
-    # Iterate through regions
-    s3_clients = {}
-    for region in build_region_list('cloudtrail', args.regions, args.partition_name):
+    # Start the pipeline: downloaded objects are decompressed as soon as they land on disk. Queues are bounded so that
+    # listing waits for the downloads, and downloads wait for the decompression, instead of piling up
+    record_filter = RecordFilter(args.event_name, args.event_source, args.principal, args.source_ip, time_window)
+    if not record_filter.filters and not record_filter.time_window:
+        record_filter = None
+    manifest = DownloadManifest(download_folder, get_output_fingerprint(record_filter, args.output_format))
+    writer = PartitionWriter(download_folder, args.output_format, args.target_size * 1024 * 1024) if args.output_format != 'json' else None
+    stats = OrderedDict((name, StageStats(name)) for name in ['list', 'download', 'decompress'])
+    s3_clients = S3ClientPool(credentials, list_threads + download_threads + large_object_transfer.max_request_concurrency)
+    printDebug('Workers: %d list, %d download, %d decompress' % (list_threads, download_threads, decompress_threads))
+    decompress_queue = start_stage(gunzip_file, {'Stats': stats, 'Manifest': manifest, 'Writer': writer, 'Filter': record_filter}, decompress_threads, decompress_threads * 2)
+    download_queue = start_stage(download_object, {'Stats': stats, 'Manifest': manifest, 'Writer': writer, 'Filter': record_filter, 'S3ClientPool': s3_clients, 'Stream': args.stream, 'DecompressQueue': decompress_queue}, download_threads, download_threads * 2)
+    list_queue = start_stage(list_objects, {'Stats': stats, 'DownloadQueue': download_queue, 'LastKeyTimestamp': last_delivery_time.strftime(key_timestamp_format) if time_window else None}, list_threads)
 
-        # Connect to CloudTrail
-        cloudtrail_client = connect_service('cloudtrail', credentials, region)
-        if not cloudtrail_client:
-            continue
-
-        # Get information about the S3 bucket that receives CloudTrail logs
-        trails = cloudtrail_client.describe_trails()
-        for trail in trails['trailList']:
-            bucket_name = trail['S3BucketName']
-            prefix = trail['S3KeyPrefix'] if 'S3KeyPrefix' in trail else ''
+    # Decompress files left over by a previous run (partition folders only hold output files)
+    for root, dirnames, filenames in os.walk(download_folder):
+        for filename in filenames:
+            filename = os.path.join(root, filename)
+            if filename.endswith('.tmp'):
+                os.remove(filename)
+            elif root == download_folder and filename.endswith('.gz') and os.path.getsize(filename) > 0:
+                decompress_queue.put(filename)
 
-        # Connect to S3
-        manage_dictionary(s3_clients, region, connect_service('s3', credentials, region))
-        target_bucket_region = get_s3_bucket_location(s3_clients[region], bucket_name)
-        manage_dictionary(s3_clients, target_bucket_region, connect_service('s3', credentials, target_bucket_region))
-        s3_client = s3_clients[target_bucket_region]
-
-        # Generate base path for files
-        log_path = os.path.join(prefix, cloudtrail_log_path.replace('REGION', region))
-
-        # Download files
-        printInfo('Downloading log files in %s... ' % region, False)
-        keys = []
-        for i in range(delta.days + 1):
-            day = from_date + timedelta(days=i)
-            folder_path = os.path.join(log_path, day.strftime("%Y/%m/%d"))
+    # Enumerate trails in every region
+    regions = build_region_list('cloudtrail', args.regions, args.partition_name)
+    bucket_name = args.bucket_name if type(args.bucket_name) != list else args.bucket_name[0]
+    if bucket_name:
+        trail_locations = OrderedDict([((bucket_name, ''), [])])
+    else:
+        trails = []
+        for region in regions:
+            cloudtrail_client = connect_service('cloudtrail', credentials, region)
+            if not cloudtrail_client:
+                continue
             try:
-                objects = handle_truncated_response(s3_client.list_objects, {'Bucket': bucket_name, 'Prefix': folder_path}, ['Contents'])
-                for o in objects['Contents']:
-                    keys.append([o['Key'], 0])
+                trails += cloudtrail_client.describe_trails()['trailList']
             except Exception as e:
                 printException(e)
-                pass
-        thread_work(keys, download_object, params = {'Bucket': bucket_name, 'S3Client': s3_client}, num_threads = 100)
-        printInfo('Done')
+                continue
+        trail_locations = get_trail_locations(trails)
 
-    # Iterate through files and gunzip 'em
-    printInfo('Decompressing files...')
-    gzlogs = []
-    for root, dirnames, filenames in os.walk(download_folder):
-        for filename in filenames:
-            gzlogs.append(filename)
-    thread_work(gzlogs, gunzip_file, num_threads = 30)
+    # Queue every (account, region, day) partition of every bucket/prefix on the shared listing pool
+    account_ids = [account_id for account_id in args.aws_account_id if account_id]
+    for (bucket_name, prefix), trail_names in trail_locations.items():
+
+        # Connect to S3
+        try:
+            target_bucket_region = get_s3_bucket_location(s3_clients.get(regions[0]), bucket_name)
+            s3_client = s3_clients.get(target_bucket_region)
+            account_paths = get_account_paths(s3_client, bucket_name, prefix, account_ids)
+        except Exception as e:
+            printException(e)
+            printError('Error: cannot list the log files in s3://%s/%s' % (bucket_name, prefix))
+            continue
+        printInfo('Listing log files of %d account(s) in s3://%s/%s%s...' % (len(account_paths), bucket_name, prefix, ' (%s)' % ', '.join(trail_names) if trail_names else ''))
+
+        for account_path in account_paths:
+            for region in regions:
+                log_path = os.path.join(prefix, cloudtrail_log_path.replace('AWS_ACCOUNT_ID', account_path).replace('REGION', region))
+                for i in range(delta.days + 1):
+                    day = from_date + timedelta(days=i)
+                    day_path = os.path.join(log_path, day.strftime("%Y/%m/%d"))
+                    # Skip the keys delivered before the time window
+                    start_after = os.path.join(day_path, '%s_CloudTrail_%s_%s' % (account_path.split('/')[-1], region, from_time.strftime(key_timestamp_format))) if time_window and i == 0 else ''
+                    list_queue.put((s3_client, bucket_name, day_path, start_after))
+
+    # Wait for the pipeline to drain, stage by stage
+    try:
+        list_queue.join()
+        download_queue.join()
+        decompress_queue.join()
+        if writer:
+            writer.close()
+    finally:
+        manifest.save()
+    printInfo('%d objects already downloaded' % manifest.skipped)
+    if record_filter:
+        printInfo('%d records scanned, %d kept' % (record_filter.scanned, record_filter.kept))
+    for stage in stats.values():
+        stage.report()
+    s3_clients.print_stats()
 
 
 if __name__ == '__main__':
@@ -1,24 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bisect
+import copy
+import fnmatch
+import hashlib
 import json
 import os
+import pickle
 import re
 import sys
+import tempfile
+import time
 
-from iampoliciesgonewild import all_permissions, expand_policy
+from collections import OrderedDict
+from iampoliciesgonewild import all_permissions, master_permissions_path
 
-from opinel.utils.aws import connect_service, handle_truncated_response
+from opinel.utils.aws import connect_service, get_aws_account_id, handle_truncated_response, is_throttled
 from opinel.utils.cli_parser import OpinelArgumentParser
-from opinel.utils.console import configPrintException, printInfo, printException
+from opinel.utils.console import configPrintException, printDebug, printError, printInfo, printException
 from opinel.utils.credentials import read_creds
 from opinel.utils.globals import check_requirements, manage_dictionary
+from opinel.utils.profiles import AWSProfiles
+
+from multiprocessing import Pool
+from threading import Event, Lock, Thread
+# Python2 vs Python3
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 ########################################
 ##### Globals
 ########################################
 
 PERMISSIONS_DIR = 'permissions'
+POLICY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.aws', 'recipes-cache', 'iam-policies')
+EXPANDED_POLICY_CACHE_SIZE = 1024
+ACTION_INDEX_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.awsrecipes_iam_actions.pickle')
+re_wildcard = re.compile(r'[\*\?\[]')
 re_arn = re.compile(r'^arn:(\w+?):(\w+?):(\w*?):(\d*?):(.*?)$')
 
 ########################################
@@ -26,19 +47,383 @@ re_arn = re.compile(r'^arn:(\w+?):(\w+?):(\w*?):(\d*?):(.*?)$')
 ########################################
 
 #
-# Determine whether two statements can be merged
+# Token bucket that limits the rate of API calls shared by all worker threads
 #
-def can_merge_statements(s1, s2):
-    # Action or NotAction ?
-    s1_action_type = 'Action' if 'Action' in s1 else 'NotAction'
-    s2_action_type = 'Action' if 'Action' in s2 else 'NotAction'
-    # Resource or NotResource ?
-    s1_resource_type = 'Resource' if 'Resource' in s1 else 'NotResource'
-    s2_resource_type = 'Resource' if 'Resource' in s2 else 'NotResource'
-    if s1['Effect'] == s2['Effect'] and s1_action_type == s2_action_type and s1_resource_type == s2_resource_type and s1[s1_resource_type] == s2[s2_resource_type]:
-        if ((('Condition' in s1 and 'Condition' in s2) and s1['Condition'] == s2['Condition']) or ('Condition' not in s1 and 'Condition' not in s2)):
-            return True
-    return False
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+#
+# Wrap a boto3 client so that every API call waits for a token and is retried when throttled
+#
+class ThrottledClient(object):
+
+    def __init__(self, client, rate_limiter, max_retries = 5):
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        def throttled_call(*args, **kwargs):
+            retries = 0
+            while True:
+                self.rate_limiter.acquire()
+                try:
+                    return attribute(*args, **kwargs)
+                except Exception as e:
+                    if not is_throttled(e) or retries >= self.max_retries:
+                        raise
+                    retries += 1
+                    time.sleep(2 ** retries)
+        return throttled_call
+
+#
+# Thread-safe cache; concurrent requests for the same key trigger a single fetch
+#
+class PolicyCache(dict):
+
+    def __init__(self):
+        super(PolicyCache, self).__init__()
+        self.lock = Lock()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_fetch(self, key, fetch):
+        with self.lock:
+            if key in self:
+                self.hits += 1
+                return self[key]
+            pending = key in self.pending
+            if pending:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.pending[key] = Event()
+            fetch_complete = self.pending[key]
+        if pending:
+            fetch_complete.wait()
+            return self.get(key)
+        try:
+            value = fetch()
+            if value is not None:
+                with self.lock:
+                    self[key] = value
+            return value
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+#
+# Managed policy cache that is backed by an on-disk cache and knows the default version of attached policies
+#
+class ManagedPolicyCache(PolicyCache):
+
+    def __init__(self, disk_cache = None):
+        super(ManagedPolicyCache, self).__init__()
+        self.disk_cache = disk_cache
+        self.default_versions = {}
+
+#
+# On-disk cache of managed policy documents, keyed by policy ARN and version ID, shared across runs and accounts
+#
+class PolicyDiskCache(object):
+
+    def __init__(self, cache_dir, ttl, max_size):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_path(self, policy_arn, version_id):
+        return os.path.join(self.cache_dir, '%s-%s.json' % (hashlib.sha1(policy_arn.encode('utf-8')).hexdigest(), version_id))
+
+    def get(self, policy_arn, version_id):
+        path = self.get_path(policy_arn, version_id)
+        try:
+            if os.path.isfile(path) and time.time() - os.path.getmtime(path) < self.ttl:
+                with open(path, 'rt') as f:
+                    cached_policy = json.load(f)
+                if cached_policy['PolicyArn'] == policy_arn:
+                    self.hits += 1
+                    return cached_policy['Document']
+        except Exception as e:
+            printException(e, True)
+        self.misses += 1
+        return None
+
+    def put(self, policy_arn, version_id, policy_document):
+        # Write to a temporary file first so that concurrent runs never read a partial file
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = '.tmp')
+            with os.fdopen(fd, 'wt') as f:
+                f.write(json.dumps({'PolicyArn': policy_arn, 'VersionId': version_id, 'Document': policy_document}))
+            os.rename(tmp_path, self.get_path(policy_arn, version_id))
+        except Exception as e:
+            printException(e, True)
+
+    def evict(self):
+        # Remove expired entries, then the oldest ones until the cache fits in its size limit
+        entries = []
+        now = time.time()
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime >= self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except Exception as e:
+                printException(e, True)
+        cache_size = sum(entry[1] for entry in entries)
+        for mtime, size, path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                cache_size -= size
+            except Exception as e:
+                printException(e, True)
+
+#
+# Policy document that was already expanded and merged
+#
+class MergedPolicy(dict):
+    pass
+
+#
+# Manifest of the exported permissions, used to skip unchanged principals and remove deleted ones
+# Entries are keyed by file path and hold the fingerprint of the input policies and the hash of the file contents
+#
+class PermissionsManifest(object):
+
+    def __init__(self, permissions_dir, action_index_fingerprint):
+        self.permissions_dir = permissions_dir
+        self.path = os.path.join(permissions_dir, '.manifest.json')
+        self.action_index_fingerprint = action_index_fingerprint
+        self.lock = Lock()
+        self.entries = {}
+        self.updated_entries = {}
+        self.added = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = 0
+        try:
+            with open(self.path, 'rt') as f:
+                manifest = json.load(f)
+            self.entries = manifest['permissions']
+            # Input fingerprints are meaningless once the list of IAM actions changed
+            if manifest['action_index'] != action_index_fingerprint:
+                for entry in self.entries.values():
+                    entry['inputs'] = None
+        except Exception as e:
+            printException(e, True)
+
+    def is_unchanged(self, file_path, policy_fingerprint):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and entry['inputs'] == policy_fingerprint and os.path.isfile(file_path):
+                self.updated_entries[file_path] = entry
+                self.unchanged += 1
+                return True
+        return False
+
+    def update(self, file_path, policy_fingerprint, contents):
+        # Return whether the file needs to be written
+        contents_hash = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+        with self.lock:
+            entry = self.entries.get(file_path)
+            self.updated_entries[file_path] = {'inputs': policy_fingerprint, 'contents': contents_hash}
+            if entry and entry['contents'] == contents_hash and os.path.isfile(file_path):
+                self.unchanged += 1
+                return False
+            (self.changed if entry else self.added).append(file_path)
+        return True
+
+    def remove_deleted(self, enumerated_resources):
+        # Only principals missing from a successful enumeration of their resource type are considered deleted; the
+        # entries of principals whose permissions could not be fetched or merged are kept
+        for file_path in sorted(self.entries):
+            if file_path in self.updated_entries:
+                continue
+            path_parts = os.path.relpath(file_path, self.permissions_dir).split(os.sep)
+            resource_type, resource_name = path_parts[0], '/'.join(path_parts[1:])[:-len('.json')]
+            if resource_type in enumerated_resources and resource_name not in enumerated_resources[resource_type]:
+                try:
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                    self.removed.append(file_path)
+                except Exception as e:
+                    printException(e)
+                    self.updated_entries[file_path] = self.entries[file_path]
+            else:
+                self.updated_entries[file_path] = self.entries[file_path]
+
+    def save(self):
+        if not os.path.isdir(self.permissions_dir):
+            os.makedirs(self.permissions_dir)
+        fd, tmp_path = tempfile.mkstemp(dir = self.permissions_dir, suffix = '.tmp')
+        with os.fdopen(fd, 'wt') as f:
+            f.write(json.dumps({'action_index': self.action_index_fingerprint, 'permissions': self.updated_entries}, indent = 4, sort_keys = True))
+        os.rename(tmp_path, self.path)
+
+    def print_summary(self):
+        for status, file_paths in [('Added', self.added), ('Changed', self.changed), ('Removed', self.removed)]:
+            for file_path in sorted(file_paths):
+                printInfo('%s: %s' % (status, file_path))
+        printInfo('Permissions: %d added, %d changed, %d removed, %d unchanged' % (len(self.added), len(self.changed), len(self.removed), self.unchanged))
+
+#
+# LRU cache of expanded and normalized policy documents, keyed by the hash of their canonical JSON
+# Cached documents are shared and must be treated as read-only
+#
+class ExpandedPolicyCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.policies = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0
+
+    def get(self, policy_document):
+        key = hashlib.sha1(json.dumps(policy_document, sort_keys = True).encode('utf-8')).hexdigest()
+        with self.lock:
+            if key in self.policies:
+                expanded_policy, expansion_time = self.policies.pop(key)
+                self.policies[key] = (expanded_policy, expansion_time)
+                self.hits += 1
+                self.time_saved += expansion_time
+                return expanded_policy
+        start = time.time()
+        expanded_policy = copy.deepcopy(policy_document)
+        expand_policy(policy = expanded_policy)
+        for statement in expanded_policy['Statement']:
+            normalize_statement(statement)
+        expansion_time = time.time() - start
+        with self.lock:
+            self.misses += 1
+            self.policies[key] = (expanded_policy, expansion_time)
+            while len(self.policies) > self.max_size:
+                self.policies.popitem(last = False)
+        return expanded_policy
+
+expanded_policies = ExpandedPolicyCache(EXPANDED_POLICY_CACHE_SIZE)
+
+#
+# Sorted index of all IAM actions; a wildcard only scans the actions that share its literal prefix
+#
+class ActionIndex(object):
+
+    def __init__(self, actions, fingerprint):
+        self.actions = actions
+        self.fingerprint = fingerprint
+
+    def expand(self, action):
+        # Same results as iampoliciesgonewild's wildcard expansion, in O(log(n) + matches)
+        action = action.lower()
+        if '*' not in action:
+            return [ action ]
+        prefix = re_wildcard.split(action, 1)[0]
+        match_all = (action == prefix + '*')
+        expanded_actions = []
+        for i in range(bisect.bisect_left(self.actions, prefix), len(self.actions)):
+            candidate = self.actions[i]
+            if not candidate.startswith(prefix):
+                break
+            if match_all or fnmatch.fnmatchcase(candidate, action):
+                expanded_actions.append(candidate)
+        # Wildcards for unknown services are kept as is
+        return expanded_actions if expanded_actions else [ action ]
+
+#
+# Load the action index saved next to this script, or build and save it when the list of IAM actions changed
+#
+def load_action_index():
+    fingerprint = [ master_permissions_path, os.path.getmtime(master_permissions_path), len(all_permissions) ]
+    try:
+        with open(ACTION_INDEX_FILE, 'rb') as f:
+            saved_index = pickle.load(f)
+        if saved_index['fingerprint'] == fingerprint:
+            return ActionIndex(saved_index['actions'], fingerprint)
+    except Exception:
+        pass
+    actions = sorted(set(action.lower() for action in all_permissions))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(ACTION_INDEX_FILE), suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'fingerprint': fingerprint, 'actions': actions}, f, 2)
+        os.rename(tmp_path, ACTION_INDEX_FILE)
+    except Exception:
+        pass
+    return ActionIndex(actions, fingerprint)
+
+action_index = load_action_index()
+
+#
+# Expand the actions of allow statements in place, as iampoliciesgonewild.expand_policy does
+#
+def expand_policy(policy):
+    if type(policy['Statement']) is dict:
+        policy['Statement'] = [ policy['Statement'] ]
+    for statement in policy['Statement']:
+        if statement['Effect'].lower() == 'deny':
+            continue
+        actions = set()
+        not_actions = set()
+        for action_type, expanded_actions in [('Action', actions), ('NotAction', not_actions)]:
+            statement_actions = statement.get(action_type, [])
+            for action in statement_actions if type(statement_actions) == list else [ statement_actions ]:
+                expanded_actions.update(action_index.expand(action))
+        if not_actions:
+            actions.update(all_permissions.difference(not_actions))
+        statement.pop('NotAction', None)
+        statement['Action'] = sorted(actions)
+    return policy
+
+#
+# Start the worker threads of a pipeline stage and return the stage's input queue
+#
+def start_stage(function, params, num_threads, maxsize = 0):
+    q = Queue(maxsize = maxsize)
+    for i in range(num_threads):
+        worker = Thread(target = function, args = (q, params))
+        worker.daemon = True
+        worker.start()
+    return q
+
+
+#
+# Canonical key of a normalized statement; statements with the same key can be merged
+#
+def get_statement_key(statement, action_type, resource_type):
+    condition = json.dumps(statement['Condition'], sort_keys = True) if 'Condition' in statement else None
+    return (statement['Effect'], action_type, resource_type, json.dumps(statement[resource_type]), condition)
 
 
 
@@ -59,26 +444,99 @@ def get_value_from_arn(field, arn):
 # Get managed policy
 #
 def get_managed_policy_document(iam_client, policy_arn, managed_policies):
-    policy_document = None
     print('Fetching managed policy %s...' % policy_arn)
-    # Check if we already downloaded that managed policy...
-    if policy_arn in managed_policies:
-        policy_document = managed_policies[policy_arn]
-    else:
+    def download_policy_document():
         try:
-            policy = iam_client.get_policy(PolicyArn = policy_arn)['Policy']
-            policy_document = iam_client.get_policy_version(PolicyArn = policy_arn, VersionId = policy['DefaultVersionId'])['PolicyVersion']['Document']
-            # Cache managed policies to avoid multiple download when attached to multiple IAM resources
-            manage_dictionary(managed_policies, policy_arn, policy_document)
+            disk_cache = managed_policies.disk_cache
+            version_id = managed_policies.default_versions.get(policy_arn)
+            if version_id and disk_cache:
+                policy_document = disk_cache.get(policy_arn, version_id)
+                if policy_document:
+                    return policy_document
+            if not version_id:
+                version_id = iam_client.get_policy(PolicyArn = policy_arn)['Policy']['DefaultVersionId']
+            policy_document = iam_client.get_policy_version(PolicyArn = policy_arn, VersionId = version_id)['PolicyVersion']['Document']
+            if disk_cache:
+                disk_cache.put(policy_arn, version_id, policy_document)
+            return policy_document
         except Exception as e:
             printException(e)
-    return policy_document
+    # Cache managed policies to avoid multiple download when attached to multiple IAM resources
+    return managed_policies.get_or_fetch(policy_arn, download_policy_document)
+
+#
+# Get the default version of all attached managed policies, used to revalidate the on-disk cache
+#
+def get_default_policy_versions(iam_client, managed_policies):
+    printInfo('Fetching default versions of attached managed policies...')
+    policies = handle_truncated_response(iam_client.list_policies, {'OnlyAttached': True}, ['Policies'])
+    for policy in policies['Policies']:
+        managed_policies.default_versions[policy['Arn']] = policy['DefaultVersionId']
+
+#
+# Get the merged policy of an IAM group; it is resolved once per run and shared by all members of the group
+#
+def get_group_policy(iam_client, managed_policies, group_name, snapshot, group_policies):
+    def merge_group_policies():
+        policy_documents = get_policies(iam_client, managed_policies, 'group', group_name, snapshot)
+        merged_policy = MergedPolicy(merge_policies(policy_documents))
+        merged_policy.fingerprint = get_policy_fingerprint(policy_documents)
+        # Groups without a policy version must not reset the version of their members' combined policy
+        if not merged_policy['Version']:
+            merged_policy.pop('Version')
+        return merged_policy
+    return group_policies.get_or_fetch(group_name, merge_group_policies)
+
+#
+# Get a snapshot of all IAM principals and policies with a few paginated GetAccountAuthorizationDetails calls
+#
+def get_authorization_details(iam_client, managed_policies):
+    printInfo('Fetching IAM authorization details...')
+    details = handle_truncated_response(iam_client.get_account_authorization_details, {}, ['UserDetailList', 'GroupDetailList', 'RoleDetailList', 'Policies'])
+    snapshot = {'group': {}, 'role': {}, 'user': {}}
+    for resource_type in snapshot:
+        for resource in details['%sDetailList' % resource_type.title()]:
+            snapshot[resource_type][resource['%sName' % resource_type.title()]] = {
+                'AttachedPolicies': [policy['PolicyArn'] for policy in resource.get('AttachedManagedPolicies', [])],
+                'InlinePolicies': [policy['PolicyDocument'] for policy in resource.get('%sPolicyList' % resource_type.title(), [])],
+                'Groups': resource.get('GroupList', [])
+            }
+    # Index the default version of managed policies so that they are never fetched again
+    for policy in details['Policies']:
+        for policy_version in policy['PolicyVersionList']:
+            if policy_version['IsDefaultVersion']:
+                manage_dictionary(managed_policies, policy['Arn'], policy_version['Document'])
+    return snapshot
+
+#
+# Get all policies that apply to an IAM group, role, or user from an authorization details snapshot
+#
+def get_policies_from_snapshot(iam_client, managed_policies, resource_type, resource_name, snapshot, group_policies):
+    fetched_policies = []
+    if resource_name not in snapshot[resource_type]:
+        printError('IAM %s %s does not exist.' % (resource_type, resource_name))
+        return fetched_policies
+    resource = snapshot[resource_type][resource_name]
+    # Managed policies
+    for policy_arn in resource['AttachedPolicies']:
+        fetched_policies.append(get_managed_policy_document(iam_client, policy_arn, managed_policies))
+    # Inline policies
+    fetched_policies += resource['InlinePolicies']
+    # Group policies (for users only)
+    if resource_type == 'user':
+        for group_name in resource['Groups']:
+            fetched_policies = fetched_policies + get_policies(iam_client, managed_policies, 'group', group_name, snapshot, group_policies)
+    return fetched_policies
 
 #
 # Get all policies that apply to an IAM group, role, or user
 #
-def get_policies(iam_client, managed_policies, resource_type, resource_name):
+def get_policies(iam_client, managed_policies, resource_type, resource_name, snapshot = None, group_policies = None):
+    if resource_type == 'group' and group_policies is not None:
+        return [ get_group_policy(iam_client, managed_policies, resource_name, snapshot, group_policies) ]
     print('Fetching policies for IAM %s %s...' % (resource_type, resource_name))
+    if snapshot is not None:
+        return get_policies_from_snapshot(iam_client, managed_policies, resource_type, resource_name, snapshot, group_policies)
     fetched_policies = []
     # Managed policies
     list_policy_method = getattr(iam_client, 'list_attached_' + resource_type + '_policies')
@@ -116,10 +574,22 @@ def get_policies(iam_client, managed_policies, resource_type, resource_name):
     if resource_type == 'user':
         groups = []
         for group in iam_client.list_groups_for_user(UserName = resource_name)['Groups']:
-            fetched_policies = fetched_policies + get_policies(iam_client, managed_policies, 'group', group['GroupName'])
+            fetched_policies = fetched_policies + get_policies(iam_client, managed_policies, 'group', group['GroupName'], group_policies = group_policies)
     return fetched_policies
 
 
+#
+# Fingerprint of the policy documents that apply to a principal
+#
+def get_policy_fingerprint(policy_documents):
+    fingerprint = hashlib.sha1()
+    for policy_document in policy_documents:
+        if isinstance(policy_document, MergedPolicy):
+            fingerprint.update(policy_document.fingerprint.encode('utf-8'))
+        else:
+            fingerprint.update(json.dumps(policy_document, sort_keys = True).encode('utf-8'))
+    return fingerprint.hexdigest()
+
 def merge_policies(policy_documents):
     """
     Merge multiple policy documents into a single, combined policy
@@ -129,25 +599,29 @@ def merge_policies(policy_documents):
     :return:                            Combined policy
     """
     macro_policy = {'Version': '', 'Statement': []}
+    merged_statements = {}
     for policy_document in policy_documents:
         if not policy_document:
             continue
-        expand_policy(policy = policy_document)
+        if not isinstance(policy_document, MergedPolicy):
+            policy_document = expanded_policies.get(policy_document)
         if 'Version' in policy_document:
             macro_policy['Version'] = policy_document['Version'] if policy_document['Version'] > macro_policy['Version'] else policy_document['Version']
-        for s1 in policy_document['Statement']:
-            merged = False
-            s1_action_type, s1_resource_type = normalize_statement(s1)
-            for s2 in macro_policy['Statement']:
-                s2_action_type, s2_resource_type = normalize_statement(s2)
-                if can_merge_statements(s1, s2):
-                    s2[s2_action_type] = sorted(list(set(s1[s1_action_type] + s2[s2_action_type])))
-                    merged = True
-            if not merged:
-                if 'Sid' in s1:
-                    s1.pop('Sid')
-                s1[s1_action_type] = sorted(list(set(s1[s1_action_type])))
-                macro_policy['Statement'].append(s1)
+        # Expanded and merged documents are shared: statements are copied, never modified
+        for statement in policy_document['Statement']:
+            action_type, resource_type = normalize_statement(statement)
+            statement_key = get_statement_key(statement, action_type, resource_type)
+            if statement_key in merged_statements:
+                merged_statements[statement_key][action_type].update(statement[action_type])
+            else:
+                merged_statement = dict((key, value) for key, value in statement.items() if key != 'Sid')
+                merged_statement[action_type] = set(statement[action_type])
+                merged_statements[statement_key] = merged_statement
+                macro_policy['Statement'].append(merged_statement)
+    # Sort actions once all statements are merged
+    for statement in macro_policy['Statement']:
+        action_type = 'Action' if 'Action' in statement else 'NotAction'
+        statement[action_type] = sorted(statement[action_type])
     return macro_policy
 
 #
@@ -167,22 +641,214 @@ def normalize_statement(statement):
         statement[resource_type] = [ statement[resource_type] ]
     return action_type, resource_type
 
+#
+# Get the path of the file that holds the permissions of a target
+#
+def get_permissions_path(resource_type, resource_name, permissions_dir = PERMISSIONS_DIR):
+    target_dir = os.path.join(permissions_dir, resource_type)
+    if resource_type == 'policy':
+        # Extract account ID from policy arn and make sub folder per account
+        account_id = get_value_from_arn('account_id', resource_name)
+        account_id = account_id if account_id else 'AWS'
+        target_dir = os.path.join(target_dir, account_id)
+        resource_name = resource_name.split('/')[-1]
+    return os.path.join(target_dir, '%s.json' % resource_name)
+
 #
 # Expand permissions and write the document to a file
 #
-def write_permissions(policy_document, resource_type, resource_name):
-        #merged_policy_document = merge_policies(policy_documents, all_permissions)
-        target_dir = os.path.join(PERMISSIONS_DIR, resource_type)
-        if resource_type == 'policy':
-            # Extract account ID from policy arn and make sub folder per account
-            account_id = get_value_from_arn('account_id', resource_name)
-            account_id = account_id if account_id else 'AWS'
-            target_dir = os.path.join(target_dir, account_id)
-            resource_name = resource_name.split('/')[-1]
+def write_permissions(policy_document, resource_type, resource_name, manifest = None, policy_fingerprint = None, permissions_dir = PERMISSIONS_DIR):
+        file_path = get_permissions_path(resource_type, resource_name, permissions_dir)
+        contents = json.dumps(policy_document, indent = 4, sort_keys = True)
+        # Do not rewrite files whose contents did not change
+        if manifest and not manifest.update(file_path, policy_fingerprint, contents):
+            return
+        target_dir = os.path.dirname(file_path)
         if not os.path.isdir(target_dir):
             os.makedirs(target_dir)
-        with open (os.path.join(target_dir, '%s.json' % resource_name), 'wt') as f:
-            f.write(json.dumps(policy_document, indent = 4, sort_keys = True))
+        with open (file_path, 'wt') as f:
+            f.write(contents)
+
+
+#
+# Pipeline stage: fetch all policies that apply to a target
+#
+def fetch_policies_worker(q, params):
+    while True:
+        resource_type, resource_name = q.get()
+        try:
+            if resource_type == 'policy':
+                policy_documents = [ get_managed_policy_document(params['iam_client'], resource_name, params['managed_policies']) ]
+            else:
+                policy_documents = get_policies(params['iam_client'], params['managed_policies'], resource_type, resource_name, params['snapshot'], params['group_policies'])
+            params['merge_queue'].put((resource_type, resource_name, policy_documents))
+        except Exception as e:
+            printException(e)
+        finally:
+            q.task_done()
+
+#
+# Pipeline stage: merge the policies of a target into a single document
+#
+def merge_policies_worker(q, params):
+    while True:
+        resource_type, resource_name, policy_documents = q.get()
+        try:
+            policy_fingerprint = None
+            if params['manifest']:
+                # Skip the merge when the policies that apply to the target did not change
+                policy_fingerprint = get_policy_fingerprint(policy_documents)
+                if params['manifest'].is_unchanged(get_permissions_path(resource_type, resource_name, params['permissions_dir']), policy_fingerprint):
+                    continue
+            params['write_queue'].put((resource_type, resource_name, merge_policies(policy_documents), policy_fingerprint))
+        except Exception as e:
+            printException(e)
+        finally:
+            q.task_done()
+
+#
+# Pipeline stage: write the merged document of a target
+#
+def write_permissions_worker(q, params):
+    while True:
+        resource_type, resource_name, policy_document, policy_fingerprint = q.get()
+        try:
+            write_permissions(policy_document, resource_type, resource_name, params['manifest'], policy_fingerprint, params['permissions_dir'])
+        except Exception as e:
+            printException(e)
+        finally:
+            q.task_done()
+
+
+#
+# Get the permissions of all targets in an account and write them under permissions_dir
+#
+def get_permissions(credentials, args, permissions_dir):
+
+    # Connect to IAM
+    iam_client = connect_service('iam', credentials)
+    if not iam_client:
+        return 42
+    if args.api_rate > 0:
+        iam_client = ThrottledClient(iam_client, RateLimiter(args.api_rate))
+
+    # Fetch all principals and policies at once, or revalidate the managed policies cached on disk
+    disk_cache = None
+    if not args.no_cache:
+        try:
+            disk_cache = PolicyDiskCache(POLICY_CACHE_DIR, args.cache_ttl * 86400, args.cache_size * 1024 * 1024)
+        except Exception as e:
+            printException(e)
+    managed_policies = ManagedPolicyCache(disk_cache)
+    group_policies = PolicyCache()
+    snapshot = get_authorization_details(iam_client, managed_policies) if args.snapshot else None
+    if disk_cache and snapshot is None:
+        try:
+            get_default_policy_versions(iam_client, managed_policies)
+        except Exception as e:
+            printException(e)
+
+    # Normalize targets
+    targets = []
+    for arn in args.arn:
+        arn_match = re_arn.match(arn)
+        if arn_match:
+            resource = arn_match.groups()[4].split('/')
+            targets.append((resource[0], resource[-1]))
+    for group_name in args.group_name:
+        if group_name:
+            targets.append(('group', group_name))
+    for role_name in args.role_name:
+        if role_name:
+            targets.append(('role', role_name))
+    for user_name in args.user_name:
+        if user_name:
+            targets.append(('user', user_name))
+    # Names of the principals of each resource type that was enumerated successfully
+    enumerated_resources = {}
+    for resource_type, all_resources in [('group', args.all_groups), ('role', args.all_roles), ('user', args.all_users)]:
+        if args.all or all_resources:
+            if snapshot is not None:
+                resource_names = sorted(snapshot[resource_type])
+            else:
+                printInfo('Fetching all IAM %ss...' % resource_type)
+                try:
+                    resources = handle_truncated_response(getattr(iam_client, 'list_%ss' % resource_type), {}, ['%ss' % resource_type.title()])
+                except Exception as e:
+                    printException(e)
+                    continue
+                resource_names = [resource['%sName' % resource_type.title()] for resource in resources['%ss' % resource_type.title()]]
+            enumerated_resources[resource_type] = set(resource_names)
+            targets += [(resource_type, resource_name) for resource_name in resource_names]
+
+    # Get requested managed policies
+    for policy_arn in args.policy_arn:
+        targets.append(('policy', policy_arn))
+
+    # Get all policies that apply to the targets and aggregate them into a single file
+    # Merging is CPU-bound, so it runs in a single thread
+    printInfo('Fetching all inline and managed policies in use...')
+    manifest = PermissionsManifest(permissions_dir, action_index.fingerprint) if args.incremental else None
+    queue_size = 2 * args.threads
+    write_queue = start_stage(write_permissions_worker, {'manifest': manifest, 'permissions_dir': permissions_dir}, 1, queue_size)
+    merge_queue = start_stage(merge_policies_worker, {'write_queue': write_queue, 'manifest': manifest, 'permissions_dir': permissions_dir}, 1, queue_size)
+    fetch_queue = start_stage(fetch_policies_worker, {'iam_client': iam_client, 'managed_policies': managed_policies, 'group_policies': group_policies, 'snapshot': snapshot, 'merge_queue': merge_queue}, max(1, args.threads))
+    for target in targets:
+        fetch_queue.put(target)
+    fetch_queue.join()
+    merge_queue.join()
+    write_queue.join()
+
+    # Remove the permissions of deleted principals and save the manifest
+    if manifest:
+        manifest.remove_deleted(enumerated_resources)
+        manifest.save()
+        manifest.print_summary()
+
+    # Cache statistics
+    printInfo('Managed policy cache: %d hits, %d misses' % (managed_policies.hits, managed_policies.misses))
+    printInfo('Group policy cache: %d hits, %d misses' % (group_policies.hits, group_policies.misses))
+    printDebug('Policy expansion cache: %d hits, %d misses, %.2fs of expansion saved' % (expanded_policies.hits, expanded_policies.misses, expanded_policies.time_saved))
+    if disk_cache:
+        printInfo('On-disk managed policy cache: %d hits, %d misses' % (disk_cache.hits, disk_cache.misses))
+        disk_cache.evict()
+    return 0
+
+#
+# Process pool worker: get the permissions of the account of a profile; failures do not affect other accounts
+#
+def get_account_permissions(params):
+    profile_name, args = params
+    configPrintException(args.debug)
+    result = {'profile_name': profile_name, 'account_id': None, 'error': None}
+    start = time.time()
+    try:
+        credentials = read_creds(profile_name)
+        if not credentials['AccessKeyId']:
+            raise Exception('Failed to read credentials for profile %s' % profile_name)
+        result['account_id'] = get_aws_account_id(credentials)
+        if get_permissions(credentials, args, os.path.join(PERMISSIONS_DIR, result['account_id'])) != 0:
+            raise Exception('Failed to get the permissions of profile %s' % profile_name)
+    except Exception as e:
+        printException(e)
+        result['error'] = str(e)
+    result['elapsed'] = time.time() - start
+    return result
+
+#
+# Get the profiles to go through: the given profile names (regular expressions are accepted), or the
+# organization profiles that assume a role from the given profile (see awsrecipes_configure_organization_profiles.py)
+# A profile defined in both the credentials and config files is only returned once
+#
+def get_profile_names(args):
+    if args.all_org_profiles:
+        source_profile_name = args.profile[0]
+        profile_names = [profile.name for profile in AWSProfiles.get(['.*'], quiet = True) if 'role_arn' in profile.attributes and profile.attributes.get('source_profile') == source_profile_name]
+    else:
+        profile_names = AWSProfiles.list(args.profile)
+        if len(profile_names) == 0:
+            profile_names = args.profile
+    return list(OrderedDict.fromkeys(profile_names))
 
 
 ########################################
@@ -236,6 +902,51 @@ def main():
                         default=False,
                         action='store_true',
                         help='Go through all IAM resources')
+    parser.parser.add_argument('--snapshot',
+                        dest='snapshot',
+                        default=False,
+                        action='store_true',
+                        help='Fetch all IAM principals and policies at once with GetAccountAuthorizationDetails and resolve permissions without further API calls')
+    parser.parser.add_argument('--threads',
+                        dest='threads',
+                        default=10,
+                        type=int,
+                        help='Number of threads fetching policies in parallel')
+    parser.parser.add_argument('--api-rate',
+                        dest='api_rate',
+                        default=10,
+                        type=float,
+                        help='Maximum number of IAM API calls per second across all threads (0 for unlimited)')
+    parser.parser.add_argument('--no-cache',
+                        dest='no_cache',
+                        default=False,
+                        action='store_true',
+                        help='Do not use the on-disk cache of managed policies (%s)' % POLICY_CACHE_DIR)
+    parser.parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        default=30,
+                        type=float,
+                        help='Number of days a cached managed policy version remains valid')
+    parser.parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        default=100,
+                        type=float,
+                        help='Maximum size of the managed policy cache, in MB')
+    parser.parser.add_argument('--incremental',
+                        dest='incremental',
+                        default=False,
+                        action='store_true',
+                        help='Only write the permissions of principals that changed since the last run, and remove those of deleted principals')
+    parser.parser.add_argument('--all-org-profiles',
+                        dest='all_org_profiles',
+                        default=False,
+                        action='store_true',
+                        help='Go through all organization profiles that assume a role from the source profile')
+    parser.parser.add_argument('--processes',
+                        dest='processes',
+                        default=0,
+                        type=int,
+                        help='Number of accounts processed in parallel when several profiles are used (defaults to the number of CPUs)')
 
     args = parser.parse_args()
 
@@ -246,59 +957,34 @@ def main():
     if not check_requirements(os.path.realpath(__file__)):
         return 42
 
-    # Arguments
-    profile_name = args.profile[0]
+    # Go through all profiles, one account per process; permissions are then written per account
+    profile_names = get_profile_names(args)
+    if not profile_names:
+        printError('No profile matches %s.' % ', '.join(args.profile))
+        return 42
+    if args.all_org_profiles or len(profile_names) > 1:
+        printInfo('Fetching permissions in %d accounts...' % len(profile_names))
+        pool = Pool(processes = args.processes if args.processes > 0 else None)
+        try:
+            results = pool.map(get_account_permissions, [(profile_name, args) for profile_name in profile_names], 1)
+        finally:
+            pool.close()
+            pool.join()
+        failed_accounts = 0
+        for result in results:
+            if result['error']:
+                failed_accounts += 1
+                printError('%s (%s): failed after %.1fs (%s)' % (result['profile_name'], result['account_id'], result['elapsed'], result['error']))
+            else:
+                printInfo('%s (%s): done in %.1fs' % (result['profile_name'], result['account_id'], result['elapsed']))
+        return 42 if failed_accounts else 0
 
     # Search for AWS credentials
-    credentials = read_creds(profile_name)
+    credentials = read_creds(profile_names[0])
     if not credentials['AccessKeyId']:
         return 42
 
-    # Connect to IAM
-    iam_client = connect_service('iam', credentials)
-    if not iam_client:
-        return 42
-
-    # Normalize targets
-    targets = []
-    for arn in args.arn:
-        arn_match = re_arn.match(arn)
-        if arn_match:
-            resource = arn_match.groups()[4].split('/')
-            targets.append((resource[0], resource[-1]))
-    for group_name in args.group_name:
-        if group_name:
-            targets.append(('group', group_name))
-    for role_name in args.role_name:
-        if role_name:
-            targets.append(('role', role_name))
-    for user_name in args.user_name:
-        if user_name:
-            targets.append(('user', user_name))
-    if args.all or args.all_groups:
-        printInfo('Fetching all IAM groups...')
-        for group in handle_truncated_response(iam_client.list_groups, {}, ['Groups'])['Groups']:
-            targets.append(('group', group['GroupName']))
-    if args.all or args.all_roles:
-        printInfo('Fetching all IAM roles...')
-        for role in handle_truncated_response(iam_client.list_roles, {}, ['Roles'])['Roles']:
-            targets.append(('role', role['RoleName']))
-    if args.all or args.all_users:
-        printInfo('Fetching all IAM users...')
-        for user in handle_truncated_response(iam_client.list_users, {}, ['Users'])['Users']:
-            targets.append(('user', user['UserName']))
-
-    # Get all policies that apply to the targets and aggregate them into a single file
-    printInfo('Fetching all inline and managed policies in use...')
-    managed_policies = {}
-    for resource_type, resource_name in targets:
-        policy_documents = get_policies(iam_client, managed_policies, resource_type, resource_name)
-        write_permissions(merge_policies(policy_documents), resource_type, resource_name)
-
-    # Get requested managed policies
-    for policy_arn in args.policy_arn:
-        policy_documents = [ get_managed_policy_document(iam_client, policy_arn, managed_policies) ]
-        write_permissions(merge_policies(policy_documents), 'policy', policy_arn)
+    return get_permissions(credentials, args, PERMISSIONS_DIR)
 
 
 ########################################
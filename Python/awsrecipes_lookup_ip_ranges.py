@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+from netaddr import IPNetwork
+
+from opinel.utils.cli_parser import OpinelArgumentParser
+from opinel.utils.console import configPrintException, printDebug, printError, printException, printInfo
+from opinel.utils.fs import read_ip_ranges
+from opinel.utils.globals import check_requirements
+
+########################################
+##### Globals
+########################################
+
+INDEX_FILE = 'ip-ranges.idx'
+index_format_version = 2
+
+# Address size, in bits, of each IP version
+address_bits = {4: 32, 6: 128}
+
+# Number of lookup results written to stdout at once
+output_batch_size = 10000
+
+# Array type of 32-bit unsigned integers ('Q' is not available in Python 2, IPv6 addresses are stored as 4 words)
+uint32_typecode = [typecode for typecode in ['I', 'L'] if array(typecode).itemsize == 4][0]
+
+
+########################################
+##### Helpers
+########################################
+
+#
+# Binary radix tree of IP prefixes; each node is [zero child, one child, value]
+#
+class RadixTree(object):
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def insert(self, network, prefix_len, value):
+        node = self.root
+        for i in range(prefix_len):
+            bit = (network >> (self.bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = value
+
+    #
+    # Flatten the tree into the sorted list of disjoint ranges, as (first address, value of the longest matching
+    # prefix or -1); each range extends to the first address of the next one
+    #
+    def get_ranges(self):
+        ranges = []
+        def emit(start, value):
+            if not ranges or ranges[-1][1] != value:
+                ranges.append((start, value))
+        def visit(node, depth, start, inherited):
+            value = node[2] if node[2] is not None else inherited
+            if node[0] is None and node[1] is None:
+                emit(start, value)
+                return
+            half = 1 << (self.bits - depth - 1)
+            for bit in [0, 1]:
+                if node[bit] is None:
+                    emit(start + bit * half, value)
+                else:
+                    visit(node[bit], depth + 1, start + bit * half, value)
+        visit(self.root, 0, 0, -1)
+        return ranges
+
+#
+# Load the prefixes of an ip-ranges file (JSON, as saved by save_ip_ranges, or JSON lines)
+#
+def load_prefixes(filename):
+    if filename.endswith('.jsonl'):
+        with open(filename, 'rt') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    return read_ip_ranges(filename)
+
+#
+# Build the index of one or many ip-ranges files; the same prefix found in several places matches all of them
+#
+def build_index(filenames):
+    trees = dict((version, RadixTree(bits)) for version, bits in address_bits.items())
+    entries = []
+    entry_ids = {}
+    for filename in filenames:
+        for prefix in load_prefixes(filename):
+            try:
+                network = IPNetwork(prefix['ip_prefix'])
+            except Exception:
+                printError('Ignoring invalid prefix %s in %s' % (prefix.get('ip_prefix'), filename))
+                continue
+            key = (network.version, network.first, network.prefixlen)
+            if key not in entry_ids:
+                entry_ids[key] = len(entries)
+                entries.append([])
+                trees[network.version].insert(network.first, network.prefixlen, entry_ids[key])
+            entries[entry_ids[key]].append(prefix)
+    ranges = dict((version, tree.get_ranges()) for version, tree in trees.items())
+    return PrefixIndex(entries, ranges)
+
+#
+# Longest-prefix-match index: the ranges of each IP version are kept as sorted arrays of first addresses (IPv6
+# addresses are split into four 32-bit words on disk) and values, and searched with bisect
+#
+class PrefixIndex(object):
+
+    def __init__(self, entries, ranges):
+        self.entries = entries
+        self.starts = {}
+        self.values = {}
+        for version, version_ranges in ranges.items():
+            self.starts[version] = [start for start, value in version_ranges]
+            self.values[version] = array('i', [value for start, value in version_ranges])
+
+    def save(self, index_file):
+        header = {'version': index_format_version, 'byteorder': sys.byteorder, 'entries': self.entries,
+                  'counts': dict((str(version), len(self.starts[version])) for version in address_bits)}
+        tmp_file = '%s.tmp' % index_file
+        with open(tmp_file, 'wb') as f:
+            f.write(json.dumps(header, sort_keys = True).encode('utf-8') + b'\n')
+            array(uint32_typecode, self.starts[4]).tofile(f)
+            for shift in [96, 64, 32, 0]:
+                array(uint32_typecode, [(start >> shift) & 0xffffffff for start in self.starts[6]]).tofile(f)
+            for version in sorted(address_bits):
+                self.values[version].tofile(f)
+        os.rename(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        index = cls([], {})
+        with open(index_file, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header['version'] != index_format_version:
+                raise Exception('Unsupported index format version %s, rebuild the index' % header['version'])
+            swap = header['byteorder'] != sys.byteorder
+            def read_array(typecode, count):
+                a = array(typecode)
+                a.fromfile(f, count)
+                if swap:
+                    a.byteswap()
+                return a
+            counts = dict((int(version), count) for version, count in header['counts'].items())
+            index.starts[4] = read_array(uint32_typecode, counts[4])
+            words = [read_array(uint32_typecode, counts[6]) for shift in [96, 64, 32, 0]]
+            index.starts[6] = [(w0 << 96) | (w1 << 64) | (w2 << 32) | w3 for w0, w1, w2, w3 in zip(*words)]
+            for version in sorted(address_bits):
+                index.values[version] = read_array('i', counts[version])
+        index.entries = header['entries']
+        return index
+
+    #
+    # Get the longest prefix that matches an address, as found in each ip-ranges file; invalid addresses match nothing
+    #
+    def lookup(self, ip):
+        entry_id = self.lookup_entry(ip)
+        return self.entries[entry_id] if entry_id >= 0 else []
+
+    def lookup_entry(self, ip):
+        try:
+            if ':' in ip:
+                w0, w1, w2, w3 = struct.unpack('!IIII', socket.inet_pton(socket.AF_INET6, ip))
+                address, version = (w0 << 96) | (w1 << 64) | (w2 << 32) | w3, 6
+            else:
+                address, version = struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0], 4
+        except (socket.error, ValueError):
+            return -1
+        return self.values[version][bisect_right(self.starts[version], address) - 1]
+
+#
+# Format the result of a lookup, either as JSON or as tab-separated values (one line per matching prefix)
+#
+def format_entry(ip, prefixes, as_json):
+    if as_json:
+        return json.dumps({'ip': ip, 'prefixes': prefixes}, sort_keys = True) + '\n'
+    if not prefixes:
+        return '%s\t\n' % ip
+    return ''.join('%s\t%s\t%s\t%s\t%s\t%s\n' % (ip, prefix.get('ip_prefix'), prefix.get('account_id'), prefix.get('region'),
+                                                 prefix.get('id', prefix.get('instance_id')), prefix.get('name')) for prefix in prefixes)
+
+#
+# Look up the addresses read from a stream, one per line, writing the results in batches
+#
+def lookup_stream(index, input_stream, output_stream, as_json):
+    formatted_entries = {}
+    lines = []
+    count = 0
+    for line in input_stream:
+        ip = line.strip()
+        if not ip:
+            continue
+        entry_id = index.lookup_entry(ip)
+        if as_json:
+            lines.append(format_entry(ip, index.entries[entry_id] if entry_id >= 0 else [], True))
+        else:
+            # The prefixes of an entry are formatted once, the address is then prepended to each line
+            if entry_id not in formatted_entries:
+                formatted = format_entry('', index.entries[entry_id] if entry_id >= 0 else [], False)
+                formatted_entries[entry_id] = formatted.splitlines(True)
+            lines += [ip + l for l in formatted_entries[entry_id]]
+        count += 1
+        if len(lines) >= output_batch_size:
+            output_stream.write(''.join(lines))
+            lines = []
+    output_stream.write(''.join(lines))
+    return count
+
+
+########################################
+##### Main
+########################################
+
+def main():
+
+    # Parse arguments
+    parser = OpinelArgumentParser()
+    parser.add_argument('debug')
+    parser.parser.add_argument('--ip-ranges',
+                        dest='ip_ranges',
+                        default=[],
+                        nargs='+',
+                        help='ip-ranges files (JSON or JSON lines) to index')
+    parser.parser.add_argument('--index-file',
+                        dest='index_file',
+                        default=INDEX_FILE,
+                        help='Path of the index (defaults to %s)' % INDEX_FILE)
+    parser.parser.add_argument('--build-index',
+                        dest='build_index',
+                        default=False,
+                        action='store_true',
+                        help='Build the index of the ip-ranges files')
+    parser.parser.add_argument('--ip',
+                        dest='ip',
+                        default=[],
+                        nargs='+',
+                        help='IP address(es) to look up')
+    parser.parser.add_argument('--lookup',
+                        dest='lookup',
+                        default=False,
+                        action='store_true',
+                        help='Look up the IP addresses read from stdin, one per line')
+    parser.parser.add_argument('--json',
+                        dest='json',
+                        default=False,
+                        action='store_true',
+                        help='Output the results as JSON lines')
+    args = parser.parse_args()
+
+    # Configure the debug level
+    configPrintException(args.debug)
+
+    # Check version of opinel
+    if not check_requirements(os.path.realpath(__file__)):
+        return 42
+
+    # Build the index
+    if args.build_index:
+        if not len(args.ip_ranges):
+            printError('Error: --build-index requires the ip-ranges files to index (--ip-ranges).')
+            return 42
+        start = time.time()
+        printInfo('Indexing %s...' % ', '.join(args.ip_ranges))
+        try:
+            index = build_index(args.ip_ranges)
+            index.save(args.index_file)
+        except Exception as e:
+            printException(e)
+            return 42
+        printInfo('Indexed %d prefixes in %.1fs' % (len(index.entries), time.time() - start))
+
+    # Look up addresses
+    if len(args.ip) or args.lookup:
+        if not os.path.isfile(args.index_file):
+            printError('Error: %s does not exist, run with --build-index first.' % args.index_file)
+            return 42
+        start = time.time()
+        try:
+            index = PrefixIndex.load(args.index_file)
+        except Exception as e:
+            printException(e)
+            return 42
+        printDebug('Loaded the index in %.1fms' % ((time.time() - start) * 1000))
+        start = time.time()
+        count = lookup_stream(index, args.ip if len(args.ip) else sys.stdin, sys.stdout, args.json)
+        printDebug('Looked up %d addresses in %.2fs' % (count, time.time() - start))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import codecs
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from opinel.utils.cli_parser import OpinelArgumentParser
+from opinel.utils.console import configPrintException, printDebug, printError, printException, printInfo
+from opinel.utils.globals import check_requirements
+
+# Optional input formats
+_zstandard_available = True
+try:
+    import zstandard
+except ImportError:
+    _zstandard_available = False
+_pyarrow_available = True
+try:
+    import pyarrow.parquet
+except ImportError:
+    _pyarrow_available = False
+
+########################################
+##### Globals
+########################################
+
+TRAILS_DIR = 'trails'
+INDEX_FILE = 'events.db'
+time_format = '%Y-%m-%dT%H:%M:%SZ'
+
+# Log files (CloudTrail format) and files of the partitioned output of awsrecipes_get_cloudtrail_logs.py
+log_file_extensions = ['.json', '.json.gz', '.jsonl.gz', '.jsonl.zst', '.parquet']
+record_batch_size = 1000
+chunk_size = 1024 * 1024
+re_whitespace = re.compile(r'[ \t\n\r]*')
+
+index_schema = [
+    'CREATE TABLE files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, record_count INTEGER)',
+    'CREATE TABLE events (event_id TEXT PRIMARY KEY, event_time TEXT, event_name TEXT, event_source TEXT, user_arn TEXT, source_ip TEXT, aws_region TEXT, record TEXT)',
+    'CREATE INDEX events_event_time ON events (event_time)',
+    'CREATE INDEX events_event_name ON events (event_name, event_time)',
+    'CREATE INDEX events_event_source ON events (event_source, event_time)',
+    'CREATE INDEX events_user_arn ON events (user_arn, event_time)',
+    'CREATE INDEX events_source_ip ON events (source_ip, event_time)',
+    'CREATE INDEX events_aws_region ON events (aws_region, event_time)',
+]
+
+# Command-line filter -> indexed column
+query_fields = [
+    ('event_name', 'event_name'),
+    ('event_source', 'event_source'),
+    ('principal', 'user_arn'),
+    ('source_ip', 'source_ip'),
+    ('aws_region', 'aws_region'),
+]
+
+
+########################################
+##### Helpers
+########################################
+
+#
+# Open the event store, creating it if needed
+#
+def open_index(index_file):
+    create = not os.path.isfile(index_file)
+    connection = sqlite3.connect(index_file)
+    if create:
+        for statement in index_schema:
+            connection.execute(statement)
+        connection.commit()
+    return connection
+
+#
+# Parse the records of a log file ({"Records": [...]}) as it is read, so that only one batch of records is held in
+# memory at a time; chunks are byte strings
+#
+class RecordReader(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def batches(self, batch_size):
+        self.expect('{')
+        if self.skip_whitespace() == '}':
+            self.position += 1
+        else:
+            while True:
+                key = self.read_value()
+                self.expect(':')
+                if key == 'Records':
+                    self.expect('[')
+                    batch = []
+                    if self.skip_whitespace() == ']':
+                        self.position += 1
+                    else:
+                        while True:
+                            batch.append(self.read_value())
+                            if len(batch) >= batch_size:
+                                yield batch
+                                batch = []
+                            if self.skip_whitespace() == ']':
+                                self.position += 1
+                                break
+                            self.expect(',')
+                    if batch:
+                        yield batch
+                else:
+                    self.read_value()
+                if self.skip_whitespace() == '}':
+                    self.position += 1
+                    break
+                self.expect(',')
+        # Only whitespace may follow the records
+        if self.skip_whitespace():
+            raise ValueError('Unexpected data after the records at offset %d' % self.position)
+
+    def read_more(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.text_decoder.decode(b'', True)
+        else:
+            text = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.position = re_whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return ''
+            self.read_more()
+
+    def expect(self, character):
+        if self.skip_whitespace() != character:
+            raise ValueError('Expected %s at offset %d of the records' % (character, self.position))
+        self.position += 1
+
+    def read_value(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+                # A value that reaches the end of the buffer may be truncated (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+#
+# Read the records of a log file in batches
+#
+def read_log_file(file_path):
+    if file_path.endswith('.json') or file_path.endswith('.json.gz'):
+        with open(file_path, 'rb') as raw:
+            f = gzip.GzipFile(fileobj = raw, mode = 'rb') if file_path.endswith('.gz') else raw
+            for records in RecordReader(iter(lambda: f.read(chunk_size), b'')).batches(record_batch_size):
+                yield records
+    elif file_path.endswith('.parquet'):
+        if not _pyarrow_available:
+            raise Exception('The pyarrow package is required to read %s' % file_path)
+        parquet_file = pyarrow.parquet.ParquetFile(file_path)
+        for i in range(parquet_file.num_row_groups):
+            yield [json.loads(record) for record in parquet_file.read_row_group(i, columns = ['record']).column('record').to_pylist()]
+    else:
+        if file_path.endswith('.jsonl.zst') and not _zstandard_available:
+            raise Exception('The zstandard package is required to read %s' % file_path)
+        with open(file_path, 'rb') as raw:
+            f = gzip.GzipFile(fileobj = raw, mode = 'rb') if file_path.endswith('.gz') else io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+            records = []
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line.decode('utf-8')))
+                if len(records) >= record_batch_size:
+                    yield records
+                    records = []
+            yield records
+
+#
+# Ingest the log files that were added or modified since the last run. Records are inserted in batches; the events of
+# a file that could not be read completely are kept, and the file is read again on the next run
+#
+def ingest_logs(trails_dir, index_file):
+    connection = open_index(index_file)
+    cursor = connection.cursor()
+    ingested_files = dict((row[0], (row[1], row[2])) for row in cursor.execute('SELECT name, size, mtime FROM files'))
+    file_count = record_count = 0
+    for root, dirnames, filenames in os.walk(trails_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not any(filename.endswith(extension) for extension in log_file_extensions) or filename.startswith('.'):
+                continue
+            file_path = os.path.join(root, filename)
+            name = os.path.relpath(file_path, trails_dir)
+            stat = os.stat(file_path)
+            if ingested_files.get(name) == (stat.st_size, stat.st_mtime):
+                continue
+            file_record_count = 0
+            try:
+                for records in read_log_file(file_path):
+                    # Records already ingested (e.g. from a previous version of the file) are identified by their event ID
+                    cursor.executemany('INSERT OR IGNORE INTO events (event_id, event_time, event_name, event_source, user_arn, source_ip, aws_region, record) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                       [(record.get('eventID'), record.get('eventTime'), record.get('eventName'), record.get('eventSource'),
+                                         record.get('userIdentity', {}).get('arn'), record.get('sourceIPAddress'), record.get('awsRegion'),
+                                         json.dumps(record, sort_keys = True)) for record in records])
+                    file_record_count += len(records)
+            except Exception as e:
+                printException(e)
+                continue
+            cursor.execute('INSERT OR REPLACE INTO files (name, size, mtime, record_count) VALUES (?, ?, ?, ?)', (name, stat.st_size, stat.st_mtime, file_record_count))
+            file_count += 1
+            record_count += file_record_count
+            if file_count % 100 == 0:
+                connection.commit()
+    connection.commit()
+    connection.close()
+    return file_count, record_count
+
+#
+# Parse a time boundary, either a date (YYYY-MM-DD) or a UTC timestamp (YYYY-MM-DDTHH:MM[:SS][Z])
+#
+def parse_time(value, end_of_day = False):
+    for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%MZ', '%Y-%m-%dT%H:%M']:
+        try:
+            return datetime.datetime.strptime(value, fmt).strftime(time_format)
+        except ValueError:
+            pass
+    day = datetime.datetime.strptime(value, '%Y-%m-%d')
+    if end_of_day:
+        day += datetime.timedelta(days = 1, seconds = -1)
+    return day.strftime(time_format)
+
+#
+# Find the events that match all filters; each filter accepts a list of values, with shell-style wildcards
+#
+def query_events(index_file, from_time = None, to_time = None, limit = None, **filters):
+    conditions = []
+    values = []
+    if from_time:
+        conditions.append('event_time >= ?')
+        values.append(from_time)
+    if to_time:
+        conditions.append('event_time <= ?')
+        values.append(to_time)
+    for argument, column in query_fields:
+        patterns = filters.get(argument) or []
+        if not patterns:
+            continue
+        # GLOB is case-sensitive like the recorded values, and still uses the index for a literal prefix
+        conditions.append('(%s)' % ' OR '.join(['%s GLOB ?' % column] * len(patterns)))
+        values += patterns
+    query = 'SELECT record FROM events'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY event_time, event_id'
+    if limit:
+        query += ' LIMIT %d' % limit
+    connection = sqlite3.connect(index_file)
+    results = [json.loads(row[0]) for row in connection.execute(query, values)]
+    connection.close()
+    return results
+
+
+########################################
+##### Main
+########################################
+
+def main():
+
+    # Parse arguments
+    parser = OpinelArgumentParser()
+    parser.add_argument('debug')
+    parser.parser.add_argument('--trails-dir',
+                        dest='trails_dir',
+                        default=TRAILS_DIR,
+                        help='Folder where awsrecipes_get_cloudtrail_logs.py downloaded the logs')
+    parser.parser.add_argument('--index-file',
+                        dest='index_file',
+                        default=None,
+                        help='Path of the event store (defaults to %s in the trails folder)' % INDEX_FILE)
+    parser.parser.add_argument('--ingest',
+                        dest='ingest',
+                        default=False,
+                        action='store_true',
+                        help='Add the log files that were not ingested yet to the event store')
+    parser.parser.add_argument('--from',
+                        dest='from_time',
+                        default=None,
+                        help='Only report events that occurred at or after this time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ)')
+    parser.parser.add_argument('--to',
+                        dest='to_time',
+                        default=None,
+                        help='Only report events that occurred at or before this time (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ)')
+    parser.parser.add_argument('--event-name',
+                        dest='event_name',
+                        default=[],
+                        nargs='+',
+                        help='Only report events with these names (e.g. ConsoleLogin, Delete*)')
+    parser.parser.add_argument('--event-source',
+                        dest='event_source',
+                        default=[],
+                        nargs='+',
+                        help='Only report events from these services (e.g. iam.amazonaws.com)')
+    parser.parser.add_argument('--principal',
+                        dest='principal',
+                        default=[],
+                        nargs='+',
+                        help='Only report events performed by these principals (ARN, e.g. arn:aws:iam::*:user/alice)')
+    parser.parser.add_argument('--source-ip',
+                        dest='source_ip',
+                        default=[],
+                        nargs='+',
+                        help='Only report events originating from these IP addresses')
+    parser.parser.add_argument('--aws-region',
+                        dest='aws_region',
+                        default=[],
+                        nargs='+',
+                        help='Only report events that occurred in these regions')
+    parser.parser.add_argument('--limit',
+                        dest='limit',
+                        default=None,
+                        type=int,
+                        help='Maximum number of events to report')
+    parser.parser.add_argument('--json',
+                        dest='json',
+                        default=False,
+                        action='store_true',
+                        help='Output the matching records as JSON lines')
+    args = parser.parse_args()
+
+    # Configure the debug level
+    configPrintException(args.debug)
+
+    # Check version of opinel
+    if not check_requirements(os.path.realpath(__file__)):
+        return 42
+
+    index_file = args.index_file if args.index_file else os.path.join(args.trails_dir, INDEX_FILE)
+
+    # Ingest new log files
+    if args.ingest:
+        start = time.time()
+        printInfo('Ingesting log files in %s...' % args.trails_dir)
+        file_count, record_count = ingest_logs(args.trails_dir, index_file)
+        printInfo('Ingested %d records from %d new file(s) in %.1fs' % (record_count, file_count, time.time() - start))
+
+    # Query the event store
+    filters = dict((argument, getattr(args, argument)) for argument, column in query_fields)
+    if args.from_time or args.to_time or any(filters.values()) or not args.ingest:
+        if not os.path.isfile(index_file):
+            printError('Error: %s does not exist, run with --ingest first.' % index_file)
+            return 42
+        try:
+            from_time = parse_time(args.from_time) if args.from_time else None
+            to_time = parse_time(args.to_time, True) if args.to_time else None
+        except Exception as e:
+            printException(e)
+            printError('Error: times must be formatted as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SSZ')
+            return 42
+        start = time.time()
+        records = query_events(index_file, from_time, to_time, args.limit, **filters)
+        printDebug('Query took %.1fms' % ((time.time() - start) * 1000))
+        for record in records:
+            if args.json:
+                printInfo(json.dumps(record, sort_keys = True))
+            else:
+                printInfo('%s\t%s\t%s\t%s\t%s\t%s' % (record.get('eventTime'), record.get('awsRegion'), record.get('eventSource'), record.get('eventName'),
+                                                      record.get('userIdentity', {}).get('arn'), record.get('sourceIPAddress')))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from opinel.utils.cli_parser import OpinelArgumentParser
+from opinel.utils.console import configPrintException, printDebug, printError, printException, printInfo
+from opinel.utils.globals import check_requirements
+
+########################################
+##### Globals
+########################################
+
+PERMISSIONS_DIR = 'permissions'
+INDEX_FILE = 'permissions.db'
+re_account_id = re.compile(r'^\d{12}$')
+re_wildcard = re.compile(r'[\*\?]')
+
+index_schema = [
+    'CREATE TABLE principals (id INTEGER PRIMARY KEY, account_id TEXT, principal_type TEXT, principal_name TEXT)',
+    'CREATE TABLE statements (id INTEGER PRIMARY KEY, principal_id INTEGER, effect TEXT, action_type TEXT, resource_type TEXT, resources TEXT, has_condition INTEGER)',
+    'CREATE TABLE actions (id INTEGER PRIMARY KEY, name TEXT UNIQUE)',
+    'CREATE TABLE grants (action_id INTEGER, statement_id INTEGER, PRIMARY KEY (action_id, statement_id)) WITHOUT ROWID',
+    'CREATE TABLE patterns (statement_id INTEGER, pattern TEXT)',
+]
+
+
+########################################
+##### Helpers
+########################################
+
+#
+# Determine the account, type and name of the principal whose permissions are stored in a file
+# Files are stored as [<account_id>/]<type>/<name>.json, and policies as [<account_id>/]policy/<policy_account_id>/<name>.json
+#
+def get_principal(permissions_dir, file_path):
+    parts = os.path.relpath(file_path, permissions_dir).split(os.sep)
+    account_id = parts.pop(0) if len(parts) > 2 and re_account_id.match(parts[0]) else None
+    principal_type = parts[0]
+    principal_name = '/'.join(parts[1:])[:-len('.json')]
+    return account_id, principal_type, principal_name
+
+#
+# Get the IDs of actions, adding the unknown ones to the index
+#
+def get_action_ids(cursor, action_ids, actions):
+    for action in actions:
+        if action not in action_ids:
+            cursor.execute('INSERT INTO actions (name) VALUES (?)', (action, ))
+            action_ids[action] = cursor.lastrowid
+    return [action_ids[action] for action in actions]
+
+#
+# Build the inverted index from actions to statements, one permissions file at a time
+#
+def build_index(permissions_dir, index_file):
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    connection = sqlite3.connect(index_file)
+    cursor = connection.cursor()
+    for statement in index_schema:
+        cursor.execute(statement)
+    action_ids = {}
+    file_count = 0
+    for root, dirnames, filenames in os.walk(permissions_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith('.json') or filename.startswith('.'):
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                with open(file_path, 'rt') as f:
+                    policy_document = json.load(f)
+            except Exception as e:
+                printException(e)
+                continue
+            cursor.execute('INSERT INTO principals (account_id, principal_type, principal_name) VALUES (?, ?, ?)', get_principal(permissions_dir, file_path))
+            principal_id = cursor.lastrowid
+            for statement in policy_document.get('Statement', []):
+                action_type = 'Action' if 'Action' in statement else 'NotAction'
+                resource_type = 'Resource' if 'Resource' in statement else 'NotResource'
+                actions = statement[action_type] if type(statement[action_type]) == list else [ statement[action_type] ]
+                resources = statement[resource_type] if type(statement[resource_type]) == list else [ statement[resource_type] ]
+                cursor.execute('INSERT INTO statements (principal_id, effect, action_type, resource_type, resources, has_condition) VALUES (?, ?, ?, ?, ?, ?)',
+                               (principal_id, statement['Effect'], action_type, resource_type, json.dumps(resources), 'Condition' in statement))
+                statement_id = cursor.lastrowid
+                # Expanded actions are looked up directly, wildcards and NotAction are matched at query time
+                actions = [action.lower() for action in actions]
+                patterns = actions if action_type == 'NotAction' else [action for action in actions if re_wildcard.search(action)]
+                exact_actions = [action for action in actions if action not in patterns]
+                cursor.executemany('INSERT OR IGNORE INTO grants (action_id, statement_id) VALUES (?, ?)', [(action_id, statement_id) for action_id in get_action_ids(cursor, action_ids, exact_actions)])
+                cursor.executemany('INSERT INTO patterns (statement_id, pattern) VALUES (?, ?)', [(statement_id, pattern) for pattern in patterns])
+            file_count += 1
+            if file_count % 1000 == 0:
+                connection.commit()
+    connection.commit()
+    connection.close()
+    return file_count
+
+#
+# Determine whether a resource ARN matches one of the resource patterns of a statement
+#
+def resource_matches(resource, resource_type, resource_patterns):
+    matches = any(fnmatch.fnmatchcase(resource, pattern) for pattern in resource_patterns)
+    return matches if resource_type == 'Resource' else not matches
+
+#
+# Find the statements that apply to an action (and optionally a resource)
+#
+def query_index(index_file, action, resource = None, effect = None):
+    action = action.lower()
+    connection = sqlite3.connect(index_file)
+    cursor = connection.cursor()
+    statement_ids = set(row[0] for row in cursor.execute('SELECT grants.statement_id FROM grants JOIN actions ON actions.id = grants.action_id WHERE actions.name = ?', (action, )))
+    patterns = {}
+    for statement_id, action_type, pattern in cursor.execute('SELECT patterns.statement_id, statements.action_type, patterns.pattern FROM patterns JOIN statements ON statements.id = patterns.statement_id'):
+        matches = fnmatch.fnmatchcase(action, pattern)
+        patterns[statement_id] = patterns.get(statement_id, False) or matches
+        if action_type == 'Action' and matches:
+            statement_ids.add(statement_id)
+    for statement_id, action_type in cursor.execute('SELECT id, action_type FROM statements WHERE action_type = ?', ('NotAction', )):
+        if not patterns.get(statement_id, False):
+            statement_ids.add(statement_id)
+    results = []
+    for statement_id in sorted(statement_ids):
+        cursor.execute('SELECT principals.account_id, principals.principal_type, principals.principal_name, statements.effect, statements.resource_type, statements.resources, statements.has_condition FROM statements JOIN principals ON principals.id = statements.principal_id WHERE statements.id = ?', (statement_id, ))
+        account_id, principal_type, principal_name, statement_effect, resource_type, resources, has_condition = cursor.fetchone()
+        resources = json.loads(resources)
+        if effect and statement_effect.lower() != effect.lower():
+            continue
+        if resource and not resource_matches(resource, resource_type, resources):
+            continue
+        results.append({'account_id': account_id, 'principal_type': principal_type, 'principal_name': principal_name, 'effect': statement_effect,
+                        'resource_type': resource_type, 'resources': resources, 'has_condition': bool(has_condition)})
+    connection.close()
+    return sorted(results, key = lambda r: (r['account_id'] or '', r['principal_type'], r['principal_name'], r['effect']))
+
+
+########################################
+##### Main
+########################################
+
+def main():
+
+    # Parse arguments
+    parser = OpinelArgumentParser()
+    parser.add_argument('debug')
+    parser.parser.add_argument('--permissions-dir',
+                        dest='permissions_dir',
+                        default=PERMISSIONS_DIR,
+                        help='Folder where awsrecipes_get_iam_permissions.py wrote the permissions')
+    parser.parser.add_argument('--index-file',
+                        dest='index_file',
+                        default=None,
+                        help='Path of the index (defaults to %s in the permissions folder)' % INDEX_FILE)
+    parser.parser.add_argument('--build-index',
+                        dest='build_index',
+                        default=False,
+                        action='store_true',
+                        help='Build the index of all exported permissions')
+    parser.parser.add_argument('--action',
+                        dest='action',
+                        default=[],
+                        nargs='+',
+                        help='Action(s) to look up (e.g. iam:PassRole)')
+    parser.parser.add_argument('--resource',
+                        dest='resource',
+                        default=None,
+                        help='Only report statements that apply to this resource ARN')
+    parser.parser.add_argument('--effect',
+                        dest='effect',
+                        default=None,
+                        choices=['Allow', 'Deny'],
+                        help='Only report statements with this effect')
+    args = parser.parse_args()
+
+    # Configure the debug level
+    configPrintException(args.debug)
+
+    # Check version of opinel
+    if not check_requirements(os.path.realpath(__file__)):
+        return 42
+
+    index_file = args.index_file if args.index_file else os.path.join(args.permissions_dir, INDEX_FILE)
+
+    # Build the index
+    if args.build_index:
+        start = time.time()
+        printInfo('Indexing permissions in %s...' % args.permissions_dir)
+        file_count = build_index(args.permissions_dir, index_file)
+        printInfo('Indexed %d principals in %.1fs' % (file_count, time.time() - start))
+
+    # Query the index
+    if len(args.action):
+        if not os.path.isfile(index_file):
+            printError('Error: %s does not exist, run with --build-index first.' % index_file)
+            return 42
+        for action in args.action:
+            start = time.time()
+            results = query_index(index_file, action, args.resource, args.effect)
+            printDebug('Query for %s took %.1fms' % (action, (time.time() - start) * 1000))
+            for result in results:
+                principal = '%s/%s' % (result['principal_type'], result['principal_name'])
+                if result['account_id']:
+                    principal = '%s/%s' % (result['account_id'], principal)
+                printInfo('%s\t%s\t%s\t%s %s%s' % (action, principal, result['effect'], result['resource_type'], ', '.join(result['resources']), ' (conditional)' if result['has_condition'] else ''))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
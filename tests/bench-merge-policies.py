@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Micro-benchmark of merge_policies (awsrecipes_get_iam_permissions.py) on synthetic policies
+#
+#   python tests/bench-merge-policies.py [number of statements]
+#
+
+import copy
+import json
+import os
+import random
+import sys
+import time
+
+from iampoliciesgonewild import all_permissions, expand_policy
+
+recipe_path = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../Python/awsrecipes_get_iam_permissions.py'))
+try:
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('awsrecipes_get_iam_permissions', recipe_path)
+    recipe = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(recipe)
+except ImportError:
+    import imp
+    recipe = imp.load_source('awsrecipes_get_iam_permissions', recipe_path)
+
+
+#
+# Pairwise merge, as implemented before statements were bucketed by key
+#
+def can_merge_statements(s1, s2):
+    s1_action_type = 'Action' if 'Action' in s1 else 'NotAction'
+    s2_action_type = 'Action' if 'Action' in s2 else 'NotAction'
+    s1_resource_type = 'Resource' if 'Resource' in s1 else 'NotResource'
+    s2_resource_type = 'Resource' if 'Resource' in s2 else 'NotResource'
+    if s1['Effect'] == s2['Effect'] and s1_action_type == s2_action_type and s1_resource_type == s2_resource_type and s1[s1_resource_type] == s2[s2_resource_type]:
+        if ((('Condition' in s1 and 'Condition' in s2) and s1['Condition'] == s2['Condition']) or ('Condition' not in s1 and 'Condition' not in s2)):
+            return True
+    return False
+
+def pairwise_merge_policies(policy_documents):
+    macro_policy = {'Version': '', 'Statement': []}
+    for policy_document in policy_documents:
+        if not policy_document:
+            continue
+        policy_document = copy.deepcopy(policy_document)
+        expand_policy(policy = policy_document)
+        if 'Version' in policy_document:
+            macro_policy['Version'] = policy_document['Version'] if policy_document['Version'] > macro_policy['Version'] else policy_document['Version']
+        for s1 in policy_document['Statement']:
+            merged = False
+            s1_action_type, s1_resource_type = recipe.normalize_statement(s1)
+            for s2 in macro_policy['Statement']:
+                s2_action_type, s2_resource_type = recipe.normalize_statement(s2)
+                if can_merge_statements(s1, s2):
+                    s2[s2_action_type] = sorted(list(set(s1[s1_action_type] + s2[s2_action_type])))
+                    merged = True
+            if not merged:
+                if 'Sid' in s1:
+                    s1.pop('Sid')
+                s1[s1_action_type] = sorted(list(set(s1[s1_action_type])))
+                macro_policy['Statement'].append(s1)
+    return macro_policy
+
+
+#
+# Generate policies with statements spread over a pool of resources and conditions
+#
+def generate_policies(statement_count, statements_per_policy = 10):
+    random.seed(0)
+    actions = sorted(all_permissions)
+    policy_documents = []
+    for i in range(0, statement_count, statements_per_policy):
+        statements = []
+        for j in range(statements_per_policy):
+            statement = {'Sid': 'S%d' % (i + j), 'Effect': random.choice(['Allow', 'Allow', 'Allow', 'Deny'])}
+            statement['Action'] = random.sample(actions, random.randint(1, 5))
+            statement['Resource'] = 'arn:aws:s3:::bucket-%d/*' % random.randint(0, statement_count // 4)
+            if random.random() < 0.2:
+                statement['Condition'] = {'Bool': {'aws:SecureTransport': random.choice(['true', 'false'])}}
+            statements.append(statement)
+        policy_documents.append({'Version': '2012-10-17', 'Statement': statements})
+    return policy_documents
+
+
+def main():
+    statement_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    policy_documents = generate_policies(statement_count)
+    results = {}
+    for name, merge in [('pairwise', pairwise_merge_policies), ('bucketed', recipe.merge_policies)]:
+        start = time.time()
+        merged_policy = merge(policy_documents)
+        elapsed = time.time() - start
+        results[name] = json.dumps(merged_policy, indent = 4, sort_keys = True)
+        print('%-10s %6d statements -> %6d merged statements in %.3fs' % (name, statement_count, len(merged_policy['Statement']), elapsed))
+    print('Identical output: %s' % (results['pairwise'] == results['bucketed']))
+
+
+if __name__ == '__main__':
+    main()
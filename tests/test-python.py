@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import io
+import json
 import os
+import shutil
+import tempfile
 from subprocess import Popen, PIPE
+from threading import Thread
 
 from opinel.utils.console import printError
 from opinel.utils.fs import read_ip_ranges
@@ -29,6 +35,21 @@ class TestPythonRecipesClass:
         self.data_dir = 'tests/data'
         self.result_dir = 'tests/results'
 
+    #
+    # Load a recipe as a module
+    #
+    def load_recipe(self, recipe):
+        recipe_path = os.path.join(self.recipes_dir, '%s.py' % recipe)
+        try:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(recipe, recipe_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except ImportError:
+            import imp
+            module = imp.load_source(recipe, recipe_path)
+        return module
+
     #
     # Every Python recipe must run fine with --help
     #
@@ -113,6 +134,96 @@ class TestPythonRecipesClass:
                 successful_aws_recipes_create_ip_ranges_runs = False
             os.remove('ip-ranges-default.json')
         assert(successful_aws_recipes_create_ip_ranges_runs)
+        # Aggregation and overlaps
+        recipe = self.load_recipe('awsrecipes_create_ip_ranges')
+        prefixes = [{'ip_prefix': '10.0.0.0/24', 'account_id': 'a'}, {'ip_prefix': '10.0.1.0/24', 'account_id': 'a'},
+                    {'ip_prefix': '10.0.1.128/25', 'account_id': 'a'}, {'ip_prefix': '10.0.0.0/24', 'account_id': 'a'},
+                    {'ip_prefix': '10.0.2.0/24', 'account_id': 'b'}, {'ip_prefix': '10.0.1.5', 'account_id': 'b'}]
+        ranges = recipe.get_prefix_ranges(prefixes)
+        assert(recipe.aggregate_prefixes(ranges, ['account_id']) == [{'ip_prefix': '10.0.0.0/23', 'account_id': 'a'},
+                                                                     {'ip_prefix': '10.0.1.5/32', 'account_id': 'b'},
+                                                                     {'ip_prefix': '10.0.2.0/24', 'account_id': 'b'}])
+        assert(recipe.aggregate_prefixes(ranges, []) == [{'ip_prefix': '10.0.0.0/23'}, {'ip_prefix': '10.0.2.0/24'}])
+        assert(recipe.get_overlaps(ranges) == [('10.0.1.0/24', ['a'], '10.0.1.5', ['b'])])
+        # Identical prefixes are reported once, with all the accounts and regions that use them
+        prefixes = [{'ip_prefix': '172.31.0.0/16', 'account_id': account_id, 'region': region} for account_id in ['a', 'b', 'c'] for region in ['eu-west-1', 'us-east-1']]
+        prefixes += [{'ip_prefix': '172.31.0.0/20', 'account_id': account_id, 'region': 'us-east-1'} for account_id in ['a', 'a', 'b']]
+        prefixes += [{'ip_prefix': '172.31.16.0/20', 'account_id': 'a', 'region': 'us-east-1'}]
+        all_locations = ['a/eu-west-1', 'a/us-east-1', 'b/eu-west-1', 'b/us-east-1', 'c/eu-west-1', 'c/us-east-1']
+        assert(recipe.get_overlaps(recipe.get_prefix_ranges(prefixes)) == [('172.31.0.0/16', all_locations, None, None),
+                                                                           ('172.31.0.0/20', ['a/us-east-1', 'b/us-east-1'], None, None),
+                                                                           ('172.31.0.0/16', all_locations, '172.31.0.0/20', ['a/us-east-1', 'b/us-east-1']),
+                                                                           ('172.31.0.0/16', all_locations, '172.31.16.0/20', ['a/us-east-1'])])
+        # Concurrent inventory, with a fake EC2 client per account and region
+        accounts = {'p1': '111111111111', 'p2': '222222222222'}
+        regions = ['us-east-1', 'eu-west-1']
+        class FakeEC2Client(object):
+            def __init__(self, account_id, region):
+                self.account_id = account_id
+                self.region = region
+                self.k = sorted(accounts.values()).index(account_id) * 10 + regions.index(region)
+            def describe_instances(self, **kwargs):
+                # Two pages of results
+                if 'NextToken' not in kwargs:
+                    return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'PublicIpAddress': '198.51.%d.1' % self.k, 'Tags': [{'Key': 'Name', 'Value': 'web'}]}]}], 'NextToken': 'page-2'}
+                return {'Reservations': [{'Instances': [{'InstanceId': 'i-2', 'NetworkInterfaces': [{'Association': {'PublicIp': '198.51.%d.2' % self.k}}]}]}]}
+            def describe_addresses(self, **kwargs):
+                return {'Addresses': [{'PublicIp': '198.51.%d.3' % self.k, 'InstanceId': ''}]}
+            def describe_vpcs(self, **kwargs):
+                if (self.account_id, self.region) == ('222222222222', 'eu-west-1'):
+                    raise Exception('UnauthorizedOperation')
+                return {'Vpcs': [{'VpcId': 'vpc-1', 'CidrBlock': '10.%d.0.0/16' % self.k}]}
+            def describe_subnets(self, **kwargs):
+                return {'Subnets': [{'SubnetId': 'subnet-1', 'CidrBlock': '10.%d.1.0/24' % self.k}]}
+        def expected_prefixes(account_id, region):
+            k = sorted(accounts.values()).index(account_id) * 10 + regions.index(region)
+            return [{'ip_prefix': '198.51.%d.1' % k, 'region': region, 'instance_id': 'i-1', 'is_elastic': False, 'name': 'web', 'account_id': account_id},
+                    {'ip_prefix': '198.51.%d.2' % k, 'region': region, 'instance_id': 'i-2', 'is_elastic': False, 'name': 'i-2', 'account_id': account_id},
+                    {'ip_prefix': '198.51.%d.3' % k, 'region': region, 'instance_id': None, 'is_elastic': True, 'name': None, 'account_id': account_id},
+                    {'ip_prefix': '10.%d.0.0/16' % k, 'id': 'vpc-1', 'name': 'vpc-1', 'region': region, 'account_id': account_id},
+                    {'ip_prefix': '10.%d.1.0/24' % k, 'id': 'subnet-1', 'name': 'subnet-1', 'region': region, 'account_id': account_id}]
+        recipe.connect_service = lambda service, credentials, region: FakeEC2Client(credentials['account_id'], region)
+        credentials = dict((profile_name, {'account_id': account_id}) for profile_name, account_id in accounts.items())
+        def get_inventory(*args):
+            # A unit that never completes would block the consumer forever
+            results = []
+            consumer = Thread(target = lambda: results.extend(recipe.get_inventory(*args)))
+            consumer.daemon = True
+            consumer.start()
+            consumer.join(30)
+            assert(not consumer.is_alive())
+            return results
+        for num_threads, max_pending_units in [(1, 1), (8, 1), (8, 20)]:
+            # The same profile twice
+            inventory = get_inventory(['p1', 'p2', 'p1'], credentials, regions, False, num_threads, max_pending_units)
+            assert([(profile_name, region) for profile_name, region, region_inventory, error in inventory] == [('p1', 'us-east-1'), ('p1', 'eu-west-1'), ('p2', 'us-east-1'), ('p2', 'eu-west-1')])
+            assert([str(error) for profile_name, region, region_inventory, error in inventory] == ['None', 'None', 'None', 'UnauthorizedOperation'])
+            for profile_name, region, region_inventory, error in inventory[:3]:
+                assert(recipe.get_region_prefixes(region_inventory, region, accounts[profile_name], False) == expected_prefixes(accounts[profile_name], region))
+        public_inventory = get_inventory(['p2'], credentials, regions, True, 4, 1)
+        assert([error for profile_name, region, region_inventory, error in public_inventory] == [None, None])
+        assert(recipe.get_region_prefixes(public_inventory[1][2], 'eu-west-1', '222222222222', True) == expected_prefixes('222222222222', 'eu-west-1')[:3])
+        # Files written by IPRangesWriter
+        current_dir = os.getcwd()
+        output_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(output_dir)
+            prefixes = [prefix for profile_name, region, region_inventory, error in inventory[:3] for prefix in recipe.get_region_prefixes(region_inventory, region, accounts[profile_name], False)]
+            for output_format in ['json', 'jsonl']:
+                writer = recipe.IPRangesWriter('default', output_format, True)
+                writer.write(prefixes[:5])
+                writer.write(prefixes[5:])
+                writer.close()
+                discarded_writer = recipe.IPRangesWriter('discarded', output_format, True)
+                discarded_writer.write(prefixes)
+                discarded_writer.close(True)
+            assert(read_ip_ranges('ip-ranges-default.json') == prefixes)
+            with open('ip-ranges-default.jsonl', 'rt') as f:
+                assert([json.loads(line) for line in f] == prefixes)
+            assert(sorted(os.listdir('.')) == ['ip-ranges-default.json', 'ip-ranges-default.jsonl'])
+        finally:
+            os.chdir(current_dir)
+            shutil.rmtree(output_dir)
 
     #
     #
@@ -129,8 +240,154 @@ class TestPythonRecipesClass:
     def test_awsrecipes_get_all_ips(self):
         pass
     
+    #
+    # Test awsrecipes_get_cloudtrail_logs.py
+    #
     def test_awsrecipes_get_cloudtrail_logs(self):
-        pass
+        recipe = self.load_recipe('awsrecipes_get_cloudtrail_logs')
+        recipe.configPrintException(False)
+        def gzip_data(data):
+            f = io.BytesIO()
+            with gzip.GzipFile(fileobj = f, mode = 'wb') as g:
+                g.write(data)
+            return f.getvalue()
+        def gunzip_data(data):
+            f = io.BytesIO()
+            recipe.gunzip_stream(io.BytesIO(data), f)
+            return f.getvalue()
+        # Concatenated and empty gzip members
+        assert(gunzip_data(gzip_data(b'abc') + gzip_data(b'') + gzip_data(b'def')) == b'abcdef')
+        assert(gunzip_data(gzip_data(b'')) == b'')
+        large_data = b'0123456789' * (recipe.chunk_size // 3)
+        assert(gunzip_data(gzip_data(large_data) + gzip_data(b'!')) == large_data + b'!')
+        # Truncated gzip stream
+        try:
+            gunzip_data(gzip_data(large_data)[:-4])
+            assert(False)
+        except EOFError:
+            pass
+        # Record filters
+        records = [{'eventName': 'ConsoleLogin', 'eventSource': 'signin.amazonaws.com', 'sourceIPAddress': '10.0.1.2', 'eventTime': '2018-03-01T10:00:00Z',
+                    'userIdentity': {'arn': 'arn:aws:iam::123456789012:user/alice'}},
+                   {'eventName': 'GetObject', 'eventSource': 's3.amazonaws.com', 'sourceIPAddress': 'ec2.amazonaws.com', 'eventTime': '2018-03-01T11:00:00Z',
+                    'userIdentity': {'arn': 'arn:aws:sts::123456789012:assumed-role/admin/bob'}},
+                   {'eventName': 'GetBucketAcl', 'eventSource': 's3.amazonaws.com', 'sourceIPAddress': '192.168.0.1', 'eventTime': '2018-03-02T00:00:00Z',
+                    'userIdentity': {'type': 'AWSService'}}]
+        def filtered_names(*args):
+            return [record['eventName'] for record in recipe.RecordFilter(*args).filter(records)]
+        assert(filtered_names(['Get*'], [], [], []) == ['GetObject', 'GetBucketAcl'])
+        assert(filtered_names([], ['s3.amazonaws.com'], ['*:assumed-role/*'], []) == ['GetObject'])
+        assert(filtered_names([], [], [], ['10.0.0.0/16', 'ec2.amazonaws.com']) == ['ConsoleLogin', 'GetObject'])
+        assert(filtered_names([], [], [], ['192.168.0.1'], ('2018-03-01T00:00:00Z', '2018-03-01T23:59:59Z')) == [])
+        record_filter = recipe.RecordFilter([], [], [], [], ('2018-03-01T10:30:00Z', '2018-03-02T00:00:00Z'))
+        assert(record_filter.filter(records) == records[1:] and (record_filter.scanned, record_filter.kept) == (3, 2))
+        # Time window
+        assert(recipe.parse_time('2018/03/01') == (recipe.datetime.datetime(2018, 3, 1), False))
+        assert(recipe.parse_time('2018-03-01', True) == (recipe.datetime.datetime(2018, 3, 1, 23, 59, 59), False))
+        assert(recipe.parse_time('2018-03-01T01:02:03Z') == (recipe.datetime.datetime(2018, 3, 1, 1, 2, 3), True))
+        assert(recipe.parse_time('2018-03-01T01:02', True) == (recipe.datetime.datetime(2018, 3, 1, 1, 2), True))
+        try:
+            recipe.parse_time('03/01/2018')
+            assert(False)
+        except ValueError:
+            pass
+        # Fake S3 client, with two keys per page
+        class FakeS3Client(object):
+            def __init__(self, keys):
+                self.keys = sorted(keys)
+            def list_objects_v2(self, Bucket, Prefix, Delimiter = None, StartAfter = '', ContinuationToken = None):
+                keys = [key for key in self.keys if key.startswith(Prefix) and key > StartAfter]
+                if Delimiter:
+                    common_prefixes = sorted(set(Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]))
+                    return {'CommonPrefixes': [{'Prefix': common_prefix} for common_prefix in common_prefixes]}
+                return {'Contents': [{'Key': key, 'ETag': '"%d"' % len(key), 'Size': len(key)} for key in keys[:2]], 'IsTruncated': len(keys) > 2}
+        # Listing stops at the first key delivered after the time window
+        day_path = 'AWSLogs/123456789012/CloudTrail/us-east-1/2018/03/01'
+        key_names = ['%s/123456789012_CloudTrail_us-east-1_20180301T%sZ_x.json.gz' % (day_path, hhmm) for hhmm in ['0005', '0105', '0155', '0210', '0300']]
+        download_queue = recipe.Queue()
+        last_delivery_time = recipe.parse_time('2018-03-01T01:00')[0] + recipe.delivery_delay
+        list_queue = recipe.start_stage(recipe.list_objects, {'Stats': {'list': recipe.StageStats('list')}, 'DownloadQueue': download_queue,
+                                                              'LastKeyTimestamp': last_delivery_time.strftime(recipe.key_timestamp_format)}, 1)
+        list_queue.put((FakeS3Client(key_names), 'logs', day_path, ''))
+        list_queue.join()
+        assert([download_queue.get()[2] for i in range(download_queue.qsize())] == key_names[:3])
+        assert(recipe.re_key_timestamp.search(key_names[3]).group(1) == '20180301T0210Z')
+        # Accounts of regular and organization trails
+        s3_client = FakeS3Client(['p/AWSLogs/111111111111/CloudTrail/us-east-1/2018/03/01/a.json.gz',
+                                  'p/AWSLogs/o-abcdefghij/222222222222/CloudTrail/us-east-1/2018/03/01/b.json.gz',
+                                  'p/AWSLogs/o-abcdefghij/333333333333/CloudTrail/us-east-1/2018/03/01/c.json.gz',
+                                  'p/AWSLogs/o-abcdefghij/CloudTrail-Digest/d.json.gz', 'AWSLogs/444444444444/CloudTrail/e.json.gz'])
+        assert(recipe.get_account_paths(s3_client, 'logs', 'p', []) == ['111111111111', 'o-abcdefghij/222222222222', 'o-abcdefghij/333333333333'])
+        assert(recipe.get_account_paths(s3_client, 'logs', 'p', ['333333333333']) == ['o-abcdefghij/333333333333'])
+        assert(recipe.get_account_paths(s3_client, 'logs', '', []) == ['444444444444'])
+        # Multi-region trails are listed once per location
+        trails = [{'Name': 'all', 'S3BucketName': 'logs'}, {'Name': 'org', 'S3BucketName': 'logs', 'S3KeyPrefix': 'p'},
+                  {'Name': 'all', 'S3BucketName': 'logs'}, {'Name': 'other', 'S3BucketName': 'logs'}]
+        assert(list(recipe.get_trail_locations(trails).items()) == [(('logs', ''), ['all', 'other']), (('logs', 'p'), ['org'])])
+        # Objects written to another output format are fetched again
+        record_filter = recipe.RecordFilter(['Get*'], [], [], [])
+        assert(recipe.get_output_fingerprint(None, 'json') is None)
+        assert(recipe.get_output_fingerprint(record_filter, 'json') == record_filter.get_fingerprint())
+        assert(len(set([recipe.get_output_fingerprint(record_filter, output_format) for output_format in recipe.output_formats])) == len(recipe.output_formats))
+        download_dir = tempfile.mkdtemp()
+        try:
+            # Manifest: appended updates are reloaded, the last update of an object wins
+            manifest = recipe.DownloadManifest(download_dir, 'filters')
+            filename = os.path.join(download_dir, 'b.json.gz')
+            manifest.update('logs', 'k/a.json.gz', '"1"', 10, 'done')
+            manifest.update('logs', 'k/b.json.gz', '"2"', 20, 'downloaded', filename)
+            assert(manifest.is_complete('logs', 'k/a.json.gz', '"1"', 10, 'a.json.gz', 'a.json'))
+            assert(not manifest.is_complete('logs', 'k/a.json.gz', '"3"', 10, 'a.json.gz', 'a.json'))
+            assert(not manifest.is_complete('logs', 'k/b.json.gz', '"2"', 20, filename, filename[:-3]))
+            manifest.set_decompressed(filename)
+            with open(manifest.path, 'at') as f:
+                f.write('{"bucket": "logs", "key": "k/c.js')
+            manifest = recipe.DownloadManifest(download_dir, 'filters')
+            assert(manifest.is_complete('logs', 'k/b.json.gz', '"2"', 20, filename, filename[:-3]))
+            assert(not recipe.DownloadManifest(download_dir, 'other filters').is_complete('logs', 'k/a.json.gz', '"1"', 10, 'a.json.gz', 'a.json'))
+            manifest.update('logs', 'k/c.json.gz', '"4"', 40, 'done')
+            manifest.save()
+            with open(manifest.path, 'rt') as f:
+                assert([json.loads(line)['key'] for line in f] == ['k/a.json.gz', 'k/b.json.gz', 'k/c.json.gz'])
+            # Filtered log files keep the format of CloudTrail log files
+            log_file = gzip_data(json.dumps({'Records': records}).encode('utf-8'))
+            dst = os.path.join(download_dir, '123456789012_CloudTrail_us-east-1_20180301T0005Z_x.json')
+            done = []
+            params = {'Filter': recipe.RecordFilter(['Get*'], [], [], []), 'Writer': None}
+            assert(recipe.save_log_file(io.BytesIO(log_file), dst, params, lambda: done.append(dst)) == len(json.dumps({'Records': records})))
+            with open(dst, 'rt') as f:
+                assert(json.load(f) == {'Records': records[1:]} and done == [dst])
+            # Partitioned output, rolled over at the target size; log files are done once their records are renamed
+            writer = recipe.PartitionWriter(download_dir, 'jsonl.gz', 1024 * 1024)
+            params = {'Filter': None, 'Writer': writer}
+            recipe.save_log_file(io.BytesIO(log_file), dst, params, lambda: done.append('first'))
+            writer.target_size = 1
+            recipe.save_log_file(io.BytesIO(log_file), dst, params, lambda: done.append('second'))
+            assert(done == [dst, 'first', 'second'])
+            recipe.save_log_file(io.BytesIO(log_file), dst.replace('us-east-1', 'eu-west-1'), params, lambda: done.append('third'))
+            writer.close()
+            assert(done == [dst, 'first', 'second', 'third'])
+            partition_dir = os.path.join(download_dir, 'account=123456789012', 'region=us-east-1', 'date=2018-03-01')
+            assert(sorted(os.listdir(partition_dir)) == ['part-00000.jsonl.gz'])
+            assert(sorted(os.listdir(os.path.join(download_dir, 'account=123456789012', 'region=eu-west-1', 'date=2018-03-01'))) == ['part-00000.jsonl.gz'])
+            with gzip.open(os.path.join(partition_dir, 'part-00000.jsonl.gz'), 'rb') as f:
+                assert([json.loads(line.decode('utf-8')) for line in f] == records * 2)
+            # A log file that fails part way leaves nothing in the partitioned output
+            writer = recipe.PartitionWriter(download_dir, 'jsonl.gz', 1024 * 1024)
+            truncated_log_file = gzip_data(json.dumps({'Records': records * 1000}).encode('utf-8'))[:-4]
+            try:
+                recipe.save_log_file(io.BytesIO(truncated_log_file), dst, {'Filter': None, 'Writer': writer}, lambda: done.append('truncated'))
+                assert(False)
+            except EOFError:
+                pass
+            writer.close()
+            assert(sorted(os.listdir(partition_dir)) == ['part-00000.jsonl.gz'] and done[-1] == 'third')
+            writer = recipe.PartitionWriter(download_dir, 'jsonl.gz', 1)
+            writer.write(recipe.get_partition(dst), records, lambda: None)
+            writer.close()
+            assert(sorted(os.listdir(partition_dir)) == ['part-00000.jsonl.gz', 'part-00001.jsonl.gz'])
+        finally:
+            shutil.rmtree(download_dir)
 
     def test_awsrecipes_create_iam_user(self):
         pass
@@ -138,8 +395,132 @@ class TestPythonRecipesClass:
     def test_awsrecipes_rotate_my_key(self):
         pass
 
+    #
+    # Test awsrecipes_get_iam_permissions.py
+    #
     def test_awsrecipes_get_iam_permissions(self):
-        pass
+        recipe = self.load_recipe('awsrecipes_get_iam_permissions')
+        with open(os.path.join(self.data_dir, 'iam-policies-1.json'), 'rt') as f:
+            policy_documents = json.load(f)
+        with open(os.path.join(self.result_dir, 'iam-permissions-1.json'), 'rt') as f:
+            known_results = f.read()
+        test_results = json.dumps(recipe.merge_policies(policy_documents), indent = 4, sort_keys = True) + '\n'
+        assert(test_results == known_results)
+        # Wildcard expansion gives the same results as iampoliciesgonewild
+        import iampoliciesgonewild
+        patterns = ['s3:?et*', 'S3:GET*', 'iam:*Role*', 'iam:PassRole', 'iam:Get*Policy', 'sqs:*Message*', 'ec2:Describe*', 's3:*', '*',
+                    'nosuchservice:*', 'nosuchservice:Get*']
+        policies = [{'Version': '2012-10-17', 'Statement': {'Effect': effect, action_type: pattern, 'Resource': '*'}}
+                    for pattern in patterns for effect in ['Allow', 'Deny'] for action_type in ['Action', 'NotAction']]
+        policies.append({'Version': '2012-10-17', 'Statement': [{'Effect': 'Allow', 'Action': patterns[:4], 'Resource': '*'},
+                                                                {'Effect': 'Allow', 'NotAction': patterns[4:7], 'Resource': '*'},
+                                                                {'Effect': 'Deny', 'NotAction': patterns[:2], 'Resource': '*'}]})
+        for policy in policies:
+            assert(recipe.expand_policy(json.loads(json.dumps(policy))) == iampoliciesgonewild.expand_policy(json.loads(json.dumps(policy))))
+        # Only principals missing from a successful enumeration are removed by incremental runs
+        recipe.configPrintException(False)
+        permissions_dir = tempfile.mkdtemp()
+        try:
+            manifest = recipe.PermissionsManifest(permissions_dir, '')
+            for resource_type, resource_name in [('user', 'alice'), ('user', 'bob'), ('user', 'carol'), ('role', 'admin')]:
+                file_path = recipe.get_permissions_path(resource_type, resource_name, permissions_dir)
+                recipe.write_permissions({}, resource_type, resource_name, manifest, '', permissions_dir)
+                manifest.entries[file_path] = manifest.updated_entries.pop(file_path)
+            manifest.is_unchanged(recipe.get_permissions_path('user', 'alice', permissions_dir), '')
+            # bob could not be fetched, carol was deleted, and roles could not be enumerated
+            manifest.remove_deleted({'user': set(['alice', 'bob'])})
+            assert(manifest.removed == [recipe.get_permissions_path('user', 'carol', permissions_dir)])
+            assert(os.path.isfile(recipe.get_permissions_path('user', 'bob', permissions_dir)))
+            assert(os.path.isfile(recipe.get_permissions_path('role', 'admin', permissions_dir)))
+        finally:
+            shutil.rmtree(permissions_dir)
+
+    #
+    # Test awsrecipes_query_iam_permissions.py
+    #
+    def test_awsrecipes_query_iam_permissions(self):
+        recipe = self.load_recipe('awsrecipes_query_iam_permissions')
+        permissions_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(permissions_dir, '123456789012', 'user'))
+            shutil.copy(os.path.join(self.result_dir, 'iam-permissions-1.json'), os.path.join(permissions_dir, '123456789012', 'user', 'alice.json'))
+            index_file = os.path.join(permissions_dir, 'permissions.db')
+            assert(recipe.build_index(permissions_dir, index_file) == 1)
+            # Expanded action
+            results = recipe.query_index(index_file, 'SQS:SendMessage', effect = 'Allow')
+            assert([(r['account_id'], r['principal_name'], r['resources']) for r in results] == [('123456789012', 'alice', ['arn:aws:sqs:us-east-1:123456789012:a', 'arn:aws:sqs:us-east-1:123456789012:b'])])
+            assert(recipe.query_index(index_file, 'sqs:SendMessage', 'arn:aws:sqs:us-east-1:123456789012:c', 'Allow') == [])
+            # Deny statements with NotAction
+            results = recipe.query_index(index_file, 's3:ListBucket', effect = 'Deny')
+            assert(len(results) == 1 and results[0]['has_condition'])
+            assert(len(recipe.query_index(index_file, 's3:DeleteObject', effect = 'Deny')) == 2)
+            assert(recipe.query_index(index_file, 'iam:ListUsers', effect = 'Deny') == [])
+        finally:
+            shutil.rmtree(permissions_dir)
+
+    #
+    # Test awsrecipes_query_cloudtrail_logs.py
+    #
+    def test_awsrecipes_query_cloudtrail_logs(self):
+        recipe = self.load_recipe('awsrecipes_query_cloudtrail_logs')
+        trails_dir = tempfile.mkdtemp()
+        try:
+            for i, region in enumerate(['us-east-1', 'eu-west-1']):
+                records = [{'eventID': '%s-%d' % (region, j), 'eventTime': '2018-03-0%dT%02d:00:00Z' % (i + 1, j), 'awsRegion': region,
+                            'eventSource': 'iam.amazonaws.com' if j % 2 else 's3.amazonaws.com', 'eventName': 'CreateUser' if j % 2 else 'GetObject',
+                            'sourceIPAddress': '10.0.0.%d' % j, 'userIdentity': {'arn': 'arn:aws:iam::123456789012:user/user%d' % (j % 3)}} for j in range(6)]
+                with open(os.path.join(trails_dir, '%s.json' % region), 'wt') as f:
+                    json.dump({'Records': records}, f)
+            index_file = os.path.join(trails_dir, 'events.db')
+            assert(recipe.ingest_logs(trails_dir, index_file) == (2, 12))
+            # Already ingested files are skipped
+            assert(recipe.ingest_logs(trails_dir, index_file) == (0, 0))
+            assert(len(recipe.query_events(index_file)) == 12)
+            records = recipe.query_events(index_file, event_name = ['CreateUser'], aws_region = ['eu-west-1'])
+            assert([r['eventID'] for r in records] == ['eu-west-1-1', 'eu-west-1-3', 'eu-west-1-5'])
+            records = recipe.query_events(index_file, recipe.parse_time('2018-03-01T02:00:00Z'), recipe.parse_time('2018-03-01', True), principal = ['*:user/user2'])
+            assert([r['eventID'] for r in records] == ['us-east-1-2', 'us-east-1-5'])
+            assert(len(recipe.query_events(index_file, source_ip = ['10.0.0.1', '10.0.0.2'], limit = 3)) == 3)
+            # Partitioned output of awsrecipes_get_cloudtrail_logs.py
+            partition_dir = os.path.join(trails_dir, 'account=123456789012', 'region=us-west-2', 'date=2018-03-03')
+            os.makedirs(partition_dir)
+            with gzip.open(os.path.join(partition_dir, 'part-00000.jsonl.gz'), 'wb') as f:
+                for j in range(3):
+                    f.write((json.dumps({'eventID': 'us-west-2-%d' % j, 'eventTime': '2018-03-03T00:00:00Z', 'awsRegion': 'us-west-2'}) + '\n').encode('utf-8'))
+            with open(os.path.join(partition_dir, '.part-1.tmp'), 'wt') as f:
+                f.write('{}')
+            # Compressed CloudTrail log file
+            with gzip.open(os.path.join(trails_dir, 'us-west-2.json.gz'), 'wb') as f:
+                f.write(json.dumps({'Records': [{'eventID': 'us-west-2-%d' % j, 'eventTime': '2018-03-04T00:00:00Z', 'awsRegion': 'us-west-2'} for j in [3, 4]]}).encode('utf-8'))
+            assert(recipe.ingest_logs(trails_dir, index_file) == (2, 5))
+            assert([r['eventID'] for r in recipe.query_events(index_file, aws_region = ['us-west-2'])] == ['us-west-2-%d' % j for j in range(5)])
+        finally:
+            shutil.rmtree(trails_dir)
+
+    #
+    # Test awsrecipes_lookup_ip_ranges.py
+    #
+    def test_awsrecipes_lookup_ip_ranges(self):
+        recipe = self.load_recipe('awsrecipes_lookup_ip_ranges')
+        index_dir = tempfile.mkdtemp()
+        try:
+            prefixes = [{'ip_prefix': '10.0.0.0/16', 'account_id': 'a'}, {'ip_prefix': '10.0.1.0/24', 'account_id': 'a'},
+                        {'ip_prefix': '10.0.1.8', 'account_id': 'b'}, {'ip_prefix': '2600:1f18::/36', 'account_id': 'c'}]
+            with open(os.path.join(index_dir, 'ip-ranges-1.json'), 'wt') as f:
+                json.dump({'createDate': '', 'prefixes': prefixes}, f)
+            with open(os.path.join(index_dir, 'ip-ranges-2.jsonl'), 'wt') as f:
+                f.write(json.dumps({'ip_prefix': '10.0.1.0/24', 'account_id': 'd'}) + '\n')
+            index_file = os.path.join(index_dir, 'ip-ranges.idx')
+            recipe.build_index([os.path.join(index_dir, f) for f in ['ip-ranges-1.json', 'ip-ranges-2.jsonl']]).save(index_file)
+            index = recipe.PrefixIndex.load(index_file)
+            # Longest prefix match, the same prefix may be found in several files
+            assert([p['account_id'] for p in index.lookup('10.0.1.8')] == ['b'])
+            assert([p['account_id'] for p in index.lookup('10.0.1.9')] == ['a', 'd'])
+            assert([p['account_id'] for p in index.lookup('10.0.2.1')] == ['a'])
+            assert([p['account_id'] for p in index.lookup('2600:1f18:1::1')] == ['c'])
+            assert(index.lookup('10.1.0.0') == [] and index.lookup('2600::1') == [] and index.lookup('invalid') == [])
+        finally:
+            shutil.rmtree(index_dir)
 
     def test_awsrecipes_create_default_iam_groups(self):
         pass